@@ -0,0 +1,309 @@
+import numpy as np
+import struct
+import secrets
+import time
+from dataclasses import fields
+from enum import Enum
+from .pfmsgs import *
+from .ppmsgs import *
+
+# Binary wire format for everything the participants exchange. Each value starts with a
+# one byte tag. Arrays are written as dtype, shape and their raw buffer, aligned so that
+# the receiver can map them with np.frombuffer straight from the receive buffer.
+# Messages larger than a block are split into a head, in which big arrays are replaced by
+# references, and row-block frames with 64 bit offsets that are written into arrays
+# preallocated by the receiver, or straight into the storage the receiver names for them.
+
+MSG_TYPES = [PFMsg, PFRequestMsg, PFDataMsg, PeerGram, PPMsg, AliceToBobMsg, BobToAliceMsg]
+ENUM_TYPES = [MsgType, ReqType, PPMsgType]
+ALIGN = 16
+INLINE_MAX = 4096
+
+U8 = struct.Struct("!B")
+U32 = struct.Struct("!I")
+I64 = struct.Struct("!q")
+U64 = struct.Struct("!Q")
+F64 = struct.Struct("!d")
+
+NONE, TRUE, FALSE = b'N', b'T', b'F'
+INT, FLOAT, STR, BYTES = b'i', b'f', b's', b'b'
+TUPLE, LIST, DICT = b't', b'l', b'd'
+ARRAY, ENUM, MSG = b'a', b'e', b'm'
+STREAM, REF, BLOCK = b'h', b'r', b'k'
+BLOCKHDR = struct.Struct("!QIQQ")
+
+_msg_ids = {cls: i for i, cls in enumerate(MSG_TYPES)}
+_enum_ids = {cls: i for i, cls in enumerate(ENUM_TYPES)}
+
+
+def dumps(obj):
+    parts = []
+    _Writer(parts).write(obj)
+    return b''.join(parts)
+
+def loads(buf):
+    return _Reader(buf).read()
+
+def is_stream(buf):
+    return bytes(buf[:1]) == STREAM
+
+def dumps_blocks(obj, block_size):
+    head = []
+    refs = []
+    writer = _Writer(head, refs)
+    writer.size = len(STREAM) + U64.size + U32.size
+    writer.write(obj)
+    if sum(len(part) for part in head) + sum(arr.nbytes for arr in refs) <= block_size:
+        yield dumps(obj)
+        return
+    stream_id = secrets.randbits(64)
+    yield STREAM + U64.pack(stream_id) + U32.pack(len(refs)) + b''.join(head)
+    for i, arr in enumerate(refs):
+        nbrows = arr.shape[0]
+        rowbytes = arr.nbytes // nbrows
+        rows_per_block = max(1, block_size // max(1, rowbytes))
+        flat = arr.reshape(-1).view(np.uint8)
+        for offset in range(0, nbrows, rows_per_block):
+            rows = min(rows_per_block, nbrows - offset)
+            hdr = BLOCK + BLOCKHDR.pack(stream_id, i, offset, rows)
+            pad = -(len(hdr) + 1) % ALIGN
+            yield b''.join((hdr, U8.pack(pad), bytes(pad), flat[offset*rowbytes:(offset+rows)*rowbytes]))
+
+
+class Ref():
+
+    # stands in for a streamed array while the head of its message is inspected, see Assembler
+
+    def __init__(self, index, dtype, shape):
+        self.index = index
+        self.dtype = dtype
+        self.shape = shape
+
+
+class Assembler():
+
+    # streams without a new block for this many seconds are dropped, e.g. when a block never
+    # arrives or went to another assembler; the sender resends the message after its timeout
+    STREAM_TIMEOUT = 300
+    MAX_BYTES = None # bytes of incomplete streams to hold at most, the oldest are dropped first
+
+    def __init__(self, destination=None):
+        # destination(obj) gets the head of a streamed message with a Ref for every streamed
+        # array and may return {ref.index: array} to write those blocks straight into
+        self.destination = destination
+        self._streams = {}
+        self._early = {}
+
+    def feed(self, buf):
+        tag = bytes(buf[:1])
+        if tag == STREAM:
+            stream_id = U64.unpack_from(buf, 1)[0]
+            targets = self.destination(self._read_head(buf, Ref)[0]) if self.destination else {}
+            def alloc(index, dtype, shape):
+                target = targets.get(index)
+                if target is not None and target.shape == shape and target.dtype == dtype:
+                    return target
+                return np.empty(shape, dtype=dtype)
+            obj, refs = self._read_head(buf, alloc)
+            held = sum(arr.nbytes for i, arr in enumerate(refs) if targets.get(i) is not arr)
+            self._streams[stream_id] = [obj, refs, sum(arr.nbytes for arr in refs), time.monotonic(), held]
+            self.evict(keep=stream_id)
+            for block in self._early.pop(stream_id, ([], 0))[0]:
+                self._fill(block)
+            return self._complete(stream_id)
+        if tag == BLOCK:
+            stream_id = BLOCKHDR.unpack_from(buf, 1)[0]
+            if stream_id not in self._streams: # block overtook its head
+                blocks = self._early.setdefault(stream_id, ([], time.monotonic()))[0]
+                blocks.append(buf)
+                return None
+            self._fill(buf)
+            return self._complete(stream_id)
+        return loads(buf)
+
+    def _read_head(self, buf, alloc):
+        reader = _Reader(buf)
+        reader.pos = 1 + U64.size + U32.size
+        reader.refs = []
+        reader.alloc = alloc
+        return reader.read(), reader.refs
+
+    def _fill(self, buf):
+        stream_id, i, offset, rows = BLOCKHDR.unpack_from(buf, 1)
+        pos = 1 + BLOCKHDR.size
+        pos += 1 + buf[pos]
+        stream = self._streams[stream_id]
+        arr = stream[1][i]
+        # row by row assignment, so that arr may be a strided view into bigger storage
+        count = rows * (arr.size // arr.shape[0])
+        arr[offset:offset+rows] = np.frombuffer(buf, dtype=arr.dtype, count=count, offset=pos).reshape((rows,) + arr.shape[1:])
+        stream[2] -= count * arr.itemsize
+        stream[3] = time.monotonic()
+
+    def _complete(self, stream_id):
+        obj, _, remaining, _, _ = self._streams[stream_id]
+        if remaining:
+            return None
+        del self._streams[stream_id]
+        return obj
+
+    def nbytes(self):
+        return sum(stream[4] for stream in self._streams.values()) \
+             + sum(len(block) for blocks, _ in self._early.values() for block in blocks)
+
+    def evict(self, keep=None):
+        deadline = time.monotonic() - self.STREAM_TIMEOUT
+        for stream_id in [sid for sid, stream in self._streams.items() if stream[3] < deadline]:
+            del self._streams[stream_id]
+        for stream_id in [sid for sid, (_, since) in self._early.items() if since < deadline]:
+            del self._early[stream_id]
+        if self.MAX_BYTES is not None:
+            held = sorted([(stream[3], sid, stream[4], self._streams) for sid, stream in self._streams.items()]
+                        + [(since, sid, sum(map(len, blocks)), self._early) for sid, (blocks, since) in self._early.items()])
+            nbytes = sum(entry[2] for entry in held)
+            for _, stream_id, size, held_in in held: # oldest first
+                if nbytes <= self.MAX_BYTES:
+                    break
+                if stream_id == keep:
+                    continue
+                del held_in[stream_id]
+                nbytes -= size
+
+    def close(self):
+        self._streams.clear()
+        self._early.clear()
+
+
+class _Writer():
+
+    def __init__(self, parts, refs=None):
+        self.parts = parts
+        self.size = 0
+        self.refs = refs
+
+    def put(self, b):
+        self.parts.append(b)
+        self.size += len(b)
+
+    def write(self, obj):
+        if obj is None:
+            self.put(NONE)
+        elif isinstance(obj, Enum):
+            self.put(ENUM + U8.pack(_enum_ids[type(obj)]) + U8.pack(obj.value))
+        elif isinstance(obj, bool):
+            self.put(TRUE if obj else FALSE)
+        elif isinstance(obj, int):
+            self.put(INT + I64.pack(obj))
+        elif isinstance(obj, float):
+            self.put(FLOAT + F64.pack(obj))
+        elif isinstance(obj, str):
+            self.write_bytes(STR, obj.encode())
+        elif isinstance(obj, (bytes, bytearray)):
+            self.write_bytes(BYTES, obj)
+        elif isinstance(obj, (tuple, list)):
+            self.put((TUPLE if isinstance(obj, tuple) else LIST) + U32.pack(len(obj)))
+            for item in obj:
+                self.write(item)
+        elif isinstance(obj, dict):
+            self.put(DICT + U32.pack(len(obj)))
+            for key, value in obj.items():
+                self.write(key)
+                self.write(value)
+        elif type(obj) in _msg_ids:
+            self.put(MSG + U8.pack(_msg_ids[type(obj)]))
+            for field in fields(obj):
+                self.write(getattr(obj, field.name))
+        elif hasattr(obj, '__array__'):
+            self.write_array(np.asarray(obj))
+        else:
+            raise TypeError(f"[Codec] Cannot encode value of type {type(obj).__name__}")
+
+    def write_bytes(self, tag, b):
+        self.put(tag + U32.pack(len(b)))
+        self.put(b)
+
+    def write_array(self, arr):
+        if arr.dtype.hasobject:
+            raise TypeError("[Codec] Cannot encode arrays of python objects")
+        arr = np.require(arr, requirements='C')
+        dtype = arr.dtype.str.encode()
+        shape = U8.pack(len(dtype)) + dtype + U8.pack(arr.ndim) + struct.pack(f"!{arr.ndim}Q", *arr.shape)
+        if self.refs is not None and arr.ndim and arr.nbytes > INLINE_MAX:
+            self.put(REF + U32.pack(len(self.refs)) + shape)
+            self.refs.append(arr)
+            return
+        hdr = ARRAY + shape
+        pad = -(self.size + len(hdr) + 1) % ALIGN
+        self.put(hdr + U8.pack(pad) + bytes(pad))
+        self.put(memoryview(arr.reshape(-1).view(np.uint8)))
+
+
+class _Reader():
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+        self.refs = None
+        self.alloc = None
+
+    def take(self, n):
+        start = self.pos
+        self.pos += n
+        return self.buf[start:self.pos]
+
+    def unpack(self, st):
+        value = st.unpack_from(self.buf, self.pos)[0]
+        self.pos += st.size
+        return value
+
+    def read(self):
+        tag = bytes(self.take(1))
+        if tag == NONE:
+            return None
+        if tag == TRUE or tag == FALSE:
+            return tag == TRUE
+        if tag == INT:
+            return self.unpack(I64)
+        if tag == FLOAT:
+            return self.unpack(F64)
+        if tag == STR:
+            return bytes(self.take(self.unpack(U32))).decode()
+        if tag == BYTES:
+            return bytes(self.take(self.unpack(U32)))
+        if tag == TUPLE:
+            return tuple(self.read() for _ in range(self.unpack(U32)))
+        if tag == LIST:
+            return [self.read() for _ in range(self.unpack(U32))]
+        if tag == DICT:
+            return {self.read(): self.read() for _ in range(self.unpack(U32))}
+        if tag == ENUM:
+            cls = ENUM_TYPES[self.unpack(U8)]
+            return cls(self.unpack(U8))
+        if tag == MSG:
+            cls = MSG_TYPES[self.unpack(U8)]
+            return cls(*(self.read() for _ in fields(cls)))
+        if tag == ARRAY:
+            return self.read_array()
+        if tag == REF:
+            index = self.unpack(U32)
+            dtype, shape = self.read_shape()
+            arr = self.alloc(index, dtype, shape)
+            self.refs.append(arr)
+            return arr
+        raise ValueError(f"[Codec] Unknown tag {tag!r} at position {self.pos-1}")
+
+    def read_shape(self):
+        dtype = np.dtype(bytes(self.take(self.unpack(U8))).decode())
+        ndim = self.unpack(U8)
+        shape = struct.unpack_from(f"!{ndim}Q", self.buf, self.pos)
+        self.pos += 8*ndim
+        return dtype, shape
+
+    def read_array(self):
+        dtype, shape = self.read_shape()
+        pad = self.unpack(U8)
+        self.pos += pad
+        count = int(np.prod(shape))
+        arr = np.frombuffer(self.buf, dtype=dtype, count=count, offset=self.pos)
+        self.pos += count * dtype.itemsize
+        return arr.reshape(shape)
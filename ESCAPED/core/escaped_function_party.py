@@ -1,9 +1,16 @@
 import numpy as np
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from datetime import datetime
 import logging
 from typing import Literal
 from .pfmsgs import *
+from . import metrics, tracing
+from .gram import Gram, triangle_size
+from .codec import Ref
+
+def _nbytes(*parts):
+    return sum(np.asarray(part).nbytes for part in parts)
+
 
 @dataclass
 class SelfMsg(PFMsg):
@@ -14,42 +21,73 @@ class SelfMsg(PFMsg):
 class ESCAPEDFunctionParty():
 
     TIMEOUT_THRESHOLD: int 
+    REQUEST_WINDOW = 1
+    GRAM_PATH = None # backs the dot product with a memory-mapped .npy file
+    DTYPE = None # precision the dot product is unmasked in, None keeps the precision of the peers
     FP_ID = 'function_party'
     peers = []
 
 
+    @tracing.traced('cooperate')
     def cooperate(self, labels=False): 
-        self.dot_product_parts = {}
+        self.prepare(labels)
+        while not self.queue_empty():
+            sender, msg = self.get_next_msg()
+            self.handle_msg(msg, sender)
+        self.finish()
+
+    def prepare(self, labels=False):
+        self.dot_product_parts = {} # halves of pairings whose other half is still missing
         self.label_parts = {}
+        self._gram = None
+        self._sizes = {}
+        self._pending_blocks = {} # unmasked before the size of every peer was known
+        self._blocks_done = 0
+        self._bytes_buffered = 0 # of the halves and pending blocks above, kept up to date as they come and go
+        self._streaming = set() # blocks that a stream is being written into
+        self._placed = set()
 
         self.req_schedule = self._plan_requests(labels=labels) 
         logging.debug("[FP] will send the following requests: %s", self.req_schedule)
         self._nb_requests = len(self.req_schedule)
         self.teardown_req = PFRequestMsg(self._nb_requests+1, ReqType.Teardown) 
 
-        self._pstates = {p : {'cur_req_id': 0, 'last_request': datetime.now(), 'still_active':True} for p in self.peers}
+        self._pstates = {p : {'next_req_id': 1, 'outstanding': {}, 'resends': 0, 'still_active':True} for p in self.peers}
         for peer in self.peers:
             self.add_to_msg_queue(SelfMsg(0, 'StartConv', peer))
         self.add_to_msg_queue(SelfMsg(0, 'TimeoutCheck'))
 
-        while not self.queue_empty():
-            sender, msg = self.get_next_msg()
-            self.handle_msg(msg, sender)
+    def finish(self):
+        self.teardown()
         
         logging.info("The function party successfully gathered all data from the input peers.")
     
 
-    def send_next_request(self, req_id, peer):
-        if req_id == self._nb_requests:
-           self._pstates[peer]['still_active'] = False
+    def waiting_for_peers(self):
+        """True while answers of peers are outstanding. Until then the timeout check stays queued,
+        so a single queued message means that nothing but incoming data can move the conversation on."""
+        return any(pstate['still_active'] for pstate in self._pstates.values())
+
+    def send_next_requests(self, peer):
+        # keep up to REQUEST_WINDOW requests in flight, answers may arrive in any order
+        pstate = self._pstates[peer]
+        outstanding = pstate['outstanding']
+        while len(outstanding) < self.REQUEST_WINDOW and pstate['next_req_id'] <= self._nb_requests:
+            req_id = pstate['next_req_id']
+            outstanding[req_id] = datetime.now()
+            pstate['next_req_id'] = req_id+1
+            self.send_request(req_id, peer)
+        if not outstanding:
+           pstate['still_active'] = False
            logging.info("[FP] Conversation with %s finished.", peer)
-        else :
-           req = self.req_schedule[req_id+1]
-           self.send_to_peer(req, peer)
-           self._pstates[peer]['cur_req_id'] = req_id+1
-           self._pstates[peer]['last_request'] =  datetime.now()
+
+    def send_request(self, req_id, peer):
+        pstate = self._pstates[peer]
+        ack = min(pstate['outstanding'], default=pstate['next_req_id'])
+        self.send_to_peer(replace(self.req_schedule[req_id], ack=ack), peer)
 
 
+    @tracing.traced('handle_msg', lambda msg, sender: {'sender': sender, **tracing.msg_args(msg)})
     def handle_msg(self, msg, sender):
        
         req_id = msg.request_id
@@ -58,7 +96,7 @@ class ESCAPEDFunctionParty():
         if msg.msg_type == 'StartConv':
             peer = msg.peer
             logging.info("[FP] Starting Conversation with %s.", peer)
-            self.send_next_request(req_id, peer)
+            self.send_next_requests(peer)
         
         elif msg.msg_type == 'EndOnlinePhase': 
             logging.info("[FP] Ending online phase.") 
@@ -71,11 +109,13 @@ class ESCAPEDFunctionParty():
             for peer, pstate in self._pstates.items():
                 if pstate['still_active']:
                     ongoing_conversations = True
-                    if (cur_time - pstate['last_request']).total_seconds() > self.TIMEOUT_THRESHOLD: 
-                        req = self.req_schedule[pstate['cur_req_id']]
-                        self.send_to_peer(req, peer)
-                        pstate['last_request'] = datetime.now()
-                        logging.info("[FP] Timeout. Resend request %i to %s.", req.request_id, peer)
+                    for out_id, sent in pstate['outstanding'].items():
+                        if (cur_time - sent).total_seconds() > self.TIMEOUT_THRESHOLD: 
+                            self.send_request(out_id, peer)
+                            pstate['outstanding'][out_id] = datetime.now()
+                            pstate['resends'] += 1
+                            metrics.inc('fp_resends_total', peer=peer)
+                            logging.info("[FP] Timeout. Resend request %i to %s.", out_id, peer)
             if ongoing_conversations:
                 self.add_to_msg_queue(msg)
             else:
@@ -83,38 +123,33 @@ class ESCAPEDFunctionParty():
 
         else: # data from input party 
             peer = sender
-            if self._pstates[peer]['cur_req_id'] > req_id:
+            if req_id not in self._pstates[peer]['outstanding']:
                 logging.debug("[FP] Got data of request %i from %s again. Ignore.", req_id, peer)
                 return 
 
             elif msg.msg_type == MsgType.OwnGram:
                 dot_product = msg.data
                 logging.debug("[FP] Got dot_product from %s.", peer)
-                pairing_id = (peer, peer)
-                self.dot_product_parts[pairing_id] = (dot_product, np.zeros_like(dot_product))
-    
-            elif msg.msg_type == MsgType.AliceGram:
-                pairing_id = msg.data.pairing_id
-                component = msg.data.component
-                unmasker = msg.data.unmasker
-                logging.debug("[FP] Got dot product part ALICE from %s for %s", sender, pairing_id)
-                if pairing_id in self.dot_product_parts:
-                    c, u = self.dot_product_parts[pairing_id]
-                    self.dot_product_parts[pairing_id] = (c + component, u * unmasker)
-                else:
-                    self.dot_product_parts[pairing_id] = (component, unmasker)
+                # a one dimensional gram is the packed upper triangle
+                self._sizes[peer] = dot_product.shape[0] if dot_product.ndim == 2 else triangle_size(len(dot_product))
+                self.place_block((peer, peer), dot_product)
     
-    
-            elif msg.msg_type == MsgType.BobGram:
+            elif msg.msg_type in (MsgType.AliceGram, MsgType.BobGram):
                 pairing_id = msg.data.pairing_id
                 component = msg.data.component
                 unmasker = msg.data.unmasker
-                logging.debug("[FP] Got dot product part BOB from %s for %s", sender, pairing_id)
+                logging.debug("[FP] Got dot product part %s from %s for %s", msg.msg_type.name, sender, pairing_id)
+                p1, p2 = pairing_id
+                self._sizes.setdefault(p1, component.shape[0])
+                self._sizes.setdefault(p2, component.shape[1])
                 if pairing_id in self.dot_product_parts:
-                    c, u = self.dot_product_parts[pairing_id]
-                    self.dot_product_parts[pairing_id] = (c + component, u * unmasker)
+                    # both halves are here, unmask right away and release them
+                    c, u = self.dot_product_parts.pop(pairing_id)
+                    self._bytes_buffered -= self._resident(c, u)
+                    self.place_block(pairing_id, c, component, np.multiply(u, unmasker, dtype=self.DTYPE))
                 else:
                     self.dot_product_parts[pairing_id] = (component, unmasker)
+                    self._bytes_buffered += self._resident(component, unmasker)
     
             elif msg.msg_type == MsgType.Label: 
                 labels = msg.data
@@ -126,7 +161,13 @@ class ESCAPEDFunctionParty():
                 logging.warning("[FP]: Got message with unknown type %s.", msg.msg_type)
                 return
             
-            self.send_next_request(req_id, peer)
+            sent = self._pstates[peer]['outstanding'].pop(req_id)
+            if metrics.enabled or tracing.enabled:
+                rtt = (datetime.now() - sent).total_seconds()
+                metrics.observe('fp_request_rtt_seconds', rtt, peer=peer)
+                end = tracing.now()
+                tracing.interval('request', self.FP_ID, end - rtt, end, peer=peer, **tracing.msg_args(msg))
+            self.send_next_requests(peer)
 
     def _plan_requests(self, labels):
         tasks = [(ReqType.YourGram,)] \
@@ -135,29 +176,85 @@ class ESCAPEDFunctionParty():
                  + [(ReqType.UserDef, req) for req in self.user_def_requests()]
         return {i+1: PFRequestMsg(i+1, *task) for i, task in enumerate(tasks)} 
 
-    def get_dot_product(self, peers=None):
-        if not peers:
-            peers = self.peers
-        arrlist = []
-        for p1 in peers:
-            row = []
-            for p2 in peers:
-                if (p1, p2) in self.dot_product_parts:
-                    g1, g2 = self.dot_product_parts[(p1, p2)]
-                    g = g1 + g2
-                else:
-                    g1, g2 = self.dot_product_parts[(p2, p1)]
-                    g = np.transpose(g1 + g2)
-                row.append(g)
-            arr = np.concatenate(row, axis=1)
-            arrlist.append(arr)
-        dot_product = np.concatenate(arrlist, axis=0)
-        return dot_product
+    def place_block(self, pairing_id, *parts):
+        if self._gram is None:
+            self._pending_blocks[pairing_id] = parts
+            self._bytes_buffered += _nbytes(*parts)
+            self._allocate_gram(np.result_type(*parts))
+        else:
+            self._gram.put(*pairing_id, *parts)
+        self._streaming.discard(pairing_id)
+        self._placed.add(pairing_id)
+        self._blocks_done += 1
+        self.report_progress(self.progress())
+
+    def _allocate_gram(self, dtype):
+        # the dot product is allocated as soon as the number of samples of every peer is known
+        if self._gram is not None or len(self._sizes) < len(self.peers):
+            return
+        self._gram = Gram({p: self._sizes[p] for p in self.peers}, self.GRAM_PATH, self.DTYPE or dtype)
+        pending, self._pending_blocks = self._pending_blocks, {}
+        self._bytes_buffered -= sum(_nbytes(*pending_parts) for pending_parts in pending.values())
+        for pending_id, pending_parts in pending.items():
+            self._gram.put(*pending_id, *pending_parts)
+
+    def _resident(self, *parts):
+        return sum(np.asarray(part).nbytes for part in parts if self._gram is None or not self._gram.holds(part))
+
+    def stream_destination(self, msg, sender):
+        """Storage for the streamed arrays of a data message, as {ref index: array}. Own grams and
+        the first half of a pairing are written block by block straight into the dot product."""
+        outstanding = self._pstates.get(sender, {}).get('outstanding', {})
+        if not isinstance(msg, PFDataMsg) or msg.request_id not in outstanding:
+            return {}
+        if msg.msg_type == MsgType.OwnGram and isinstance(msg.data, Ref) and len(msg.data.shape) == 2:
+            ref, pairing_id = msg.data, (sender, sender)
+            self._sizes.setdefault(sender, ref.shape[0])
+        elif msg.msg_type in (MsgType.AliceGram, MsgType.BobGram) and isinstance(msg.data.component, Ref):
+            ref, pairing_id = msg.data.component, tuple(msg.data.pairing_id)
+            self._sizes.setdefault(pairing_id[0], ref.shape[0])
+            self._sizes.setdefault(pairing_id[1], ref.shape[1])
+            if pairing_id in self.dot_product_parts: # the second half is added to the first one
+                return {}
+        else:
+            return {}
+        if pairing_id in self._streaming or pairing_id in self._placed:
+            return {}
+        self._allocate_gram(ref.dtype)
+        if self._gram is None or self._gram.array.dtype != ref.dtype:
+            return {}
+        self._streaming.add(pairing_id)
+        return {ref.index: self._gram.block(*pairing_id)}
+
+    def progress(self):
+        nb_peers = len(self.peers)
+        gram = self._gram.array.nbytes if self._gram is not None and not isinstance(self._gram.array, np.memmap) else 0
+        return {'blocks_completed': self._blocks_done,
+                'blocks_total': nb_peers * (nb_peers+1) // 2,
+                'bytes_resident': self._bytes_buffered + gram}
+
+    def report_progress(self, progress):
+        logging.debug("[FP] %i of %i blocks of the dot product done, %i bytes resident.",
+                     progress['blocks_completed'], progress['blocks_total'], progress['bytes_resident'])
+
+    def get_dot_product(self, peers=None, path=None, lazy=False):
+        """Returns the dot product of the given peers, copied into the .npy file path if set.
+        With lazy=True a GramView is returned that reads blocks only when accessed."""
+        view = self._gram.view(peers or self.peers)
+        if lazy:
+            return view
+        self._gram.flush()
+        if not path and view.peers == self._gram.peers:
+            return self._gram.array
+        return view.materialize(path)
 
 
     def handle_userdefmsg(self, msg, sender):
         pass
 
+    def teardown(self):
+        pass
+
 
 
     def user_def_requests(self):
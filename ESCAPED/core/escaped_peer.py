@@ -2,9 +2,12 @@ import numpy as np
 import logging
 from datetime import datetime
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from .ppmsgs import *
 from .pfmsgs import *
+from .gram import pack_triangle
+from . import metrics, tracing
 
 
 PPRole = Enum('PPRole', ['Alice', 'Bob'])
@@ -15,25 +18,42 @@ class ESCAPEDPeer():
     RAND_MIN: int 
     RAND_MAX: int 
     TIMEOUT_THRESHOLD: int 
+    WORKERS = 0 # threads for masking and the matrix products, 0 computes them on the message loop
+    DTYPE = np.float64 # precision of the masked data and of every product sent
+    PACK_OWN_GRAM = False # own gram is kept and sent as packed upper triangle
     own_peer_id: str 
     peers = []
 
+    @tracing.traced('cooperate')
     def cooperate(self):
+        self.prepare()
+        while not self._teardown:
+            self.collect_results()
+            self.dispatch(*self.get_next_msg())
+        self.finish()
 
+    def prepare(self):
         # init own data and masked data
-        self.__data = self.own_data_as_np_array()
-        self.__own_dot_product = self.__data @ np.transpose(self.__data)
-        self.__masker = np.random.uniform(self.RAND_MIN, self.RAND_MAX, self.__data.shape)
-        self.__alpha = np.random.uniform(self.RAND_MIN,  self.RAND_MAX, (1))
-        masked_data = self.__data - self.__masker
-        partial_unmasker = self.__alpha * self.__masker
+        self._pool = ThreadPoolExecutor(self.WORKERS) if self.WORKERS else None
+        self._computing = deque()
+        self._waiting_own_req = None
+        self.__data = np.asarray(self.own_data_as_np_array(), dtype=self.DTYPE)
+        self.__own_dot_product = None
+        self.run_task(self._compute_own_gram, self._own_gram_done, 'own')
+        with metrics.timer('peer_mask_seconds', peer=self.own_peer_id):
+            self.__masker = self.draw_uniform(self.__data.shape)
+            self.__alpha = self.draw_uniform((1,))
+            masked_data = self.__data - self.__masker
+            partial_unmasker = self.__alpha * self.__masker
         self.alice_msg = AliceToBobMsg(PPMsgType.AliceMasked, masked_data, partial_unmasker)
         self.bob_msg = BobToAliceMsg(PPMsgType.BobMasked, masked_data)
         
         # init output buffer
         self._pgrams = deque() 
-        self._cur_fp_msg = None
-        self._cur_fp_req_id = 0
+        self._answers = {}
+        self._waiting_gram_reqs = deque()
+        self._req_arrivals = {} # when gram requests came in, for tracing their wait
+        self._fp_ack = 0
         # init state 
         self._still_waiting = {peer: True for peer in self.peers}
         self._last_timeout_check = datetime.now()
@@ -43,20 +63,76 @@ class ESCAPEDPeer():
         for peer in self.peers:
             self.share_masked_data(peer)
 
+    def dispatch(self, sender, msg):
         # handle requests 
-        while not self._teardown:
-            sender, msg = self.get_next_msg()
-            if sender == self.FP_ID: 
-                self.handle_fp_req(msg)
-            elif sender in self.peers:
-                self.handle_msg(sender, msg)
-            elif sender:
-                logging.warning("[Peer] %s. Got message from unknown or undecipherable sender %s.", self.own_peer_id, sender)
-            else:
-                pass # idle, waiting for messages
-                
+        if sender == self.FP_ID: 
+            self.handle_fp_req(msg)
+        elif sender in self.peers:
+            self.handle_msg(sender, msg)
+        elif sender:
+            logging.warning("[Peer] %s. Got message from unknown or undecipherable sender %s.", self.own_peer_id, sender)
+        else:
+            pass # idle, waiting for messages
+
+    def finish(self):
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
         self.teardown()
 
+    def draw_uniform(self, shape):
+        # row blocks are drawn from independent streams, in parallel if there is a pool
+        nb_streams = max(1, min(self.WORKERS, shape[0]))
+        streams = [np.random.default_rng(seq) for seq in np.random.SeedSequence().spawn(nb_streams)]
+        out = np.empty(shape, dtype=self.DTYPE)
+        bounds = np.linspace(0, shape[0], nb_streams+1).astype(int)
+        def fill(i):
+            block = out[bounds[i]:bounds[i+1]]
+            streams[i].random(dtype=block.dtype, out=block)
+            block *= self.RAND_MAX - self.RAND_MIN
+            block += self.RAND_MIN
+        if self._pool:
+            list(self._pool.map(fill, range(nb_streams)))
+        else:
+            fill(0)
+        return out
+
+    def run_task(self, compute, on_done, kind=None, pairing_id=None):
+        # the result is always handled on the message loop, which is woken up when it is ready
+        if kind and (metrics.enabled or tracing.enabled):
+            compute = self._timed(compute, kind, pairing_id)
+        if not self._pool:
+            on_done(compute())
+            return
+        future = self._pool.submit(compute)
+        future.add_done_callback(lambda f: self.wake())
+        self._computing.append((future, on_done))
+
+    def _timed(self, compute, kind, pairing_id):
+        def timed():
+            with metrics.timer('peer_matmul_seconds', peer=self.own_peer_id, kind=kind), \
+                    tracing.span('matmul', self.own_peer_id, kind=kind, pairing_id=pairing_id and '-'.join(pairing_id)):
+                return compute()
+        return timed
+
+    def collect_results(self):
+        computing = deque()
+        for future, on_done in self._computing:
+            if future.done():
+                on_done(future.result())
+            else:
+                computing.append((future, on_done))
+        self._computing = computing
+
+    def _compute_own_gram(self):
+        dot_product = self.__data @ np.transpose(self.__data)
+        return pack_triangle(dot_product) if self.PACK_OWN_GRAM else dot_product
+
+    def _own_gram_done(self, dot_product):
+        self.__own_dot_product = dot_product
+        if self._waiting_own_req is not None:
+            self.answer_fp_req(self._waiting_own_req, MsgType.OwnGram, dot_product)
+            self._waiting_own_req = None
+
     def share_masked_data(self, peer):
             role = self.get_role(peer)
             if role == PPRole.Alice:
@@ -67,77 +143,83 @@ class ESCAPEDPeer():
                 logging.error("[Peer] No valid role: %s", role)
 
 
+    @tracing.traced('handle_fp_req', tracing.msg_args)
     def handle_fp_req(self, req):
         self.timeout_check()
         req_id = req.request_id
-        if self._cur_fp_req_id > req_id:
-            logging.info("[Peer] %s got request %s again. Has already been answered. Will do nothing.", self.own_peer_id, req_id)
-            return
-        if self._cur_fp_req_id == req_id:
+        self._fp_ack = max(self._fp_ack, req.ack)
+        for answered in [a for a in self._answers if a < self._fp_ack]: # function party has these
+            del self._answers[answered]
+        if req_id in self._answers:
             logging.info("[Peer] %s got request %s again. Resend data to function party.", self.own_peer_id, req_id)
-            self.send_to_function_party(self._cur_fp_msg)
+            self.send_to_function_party(self._answers[req_id])
+            return
+        if req_id < self._fp_ack or req_id in self._waiting_gram_reqs or req_id == self._waiting_own_req:
+            logging.info("[Peer] %s got request %s again. Has already been answered. Will do nothing.", self.own_peer_id, req_id)
             return
         if req.req_type == ReqType.YourGram:
             logging.debug("[Peer] %s got request for own gram", self.own_peer_id)
-            msg = PFDataMsg(req_id, MsgType.OwnGram, self.__own_dot_product)
-            self._cur_fp_msg = msg
-            self._cur_fp_req_id = req_id
-            self.send_to_function_party(self._cur_fp_msg)
+            if self.__own_dot_product is None: # still being computed
+                self._waiting_own_req = req_id
+            else:
+                self.answer_fp_req(req_id, MsgType.OwnGram, self.__own_dot_product)
         elif req.req_type == ReqType.NextPeerGram:
             logging.debug("[Peer] %s get request for next gram part", self.own_peer_id)
-            try:
-                mtype, peergram = self._pgrams.popleft()
-                msg = PFDataMsg(req_id, mtype, peergram)
-                self._cur_fp_msg = msg
-                self._cur_fp_req_id = req_id
-                self.send_to_function_party(self._cur_fp_msg)
-            except:
+            self._waiting_gram_reqs.append(req_id)
+            if tracing.enabled:
+                self._req_arrivals[req_id] = tracing.now()
+            if not self._pgrams:
                 logging.info("[Peer] %s got request for next gram part, but no part is ready yet.", self.own_peer_id)
+            self.answer_gram_reqs()
         elif req.req_type == ReqType.Label:
-            mtype = MsgType.Label
-            data = self.own_labels_as_np_array()
-            msg = PFDataMsg(req_id, mtype, data)
-            self._cur_fp_msg = msg
-            self._cur_fp_req_id = req_id
-            self.send_to_function_party(self._cur_fp_msg)
+            self.answer_fp_req(req_id, MsgType.Label, self.own_labels_as_np_array())
         elif req.req_type == ReqType.UserDef:
-            mtype= MsgType.UserDef
-            data  = self.answer_userdefreq(req)
-            msg = PFDataMsg(req_id, mtype, data)
-            self._cur_fp_msg = msg
-            self._cur_fp_req_id = req_id
-            self.send_to_function_party(self._cur_fp_msg)
+            self.answer_fp_req(req_id, MsgType.UserDef, self.answer_userdefreq(req))
         elif req.req_type == ReqType.Teardown:
             logging.info("[Peer] %s got teardown request.", self.own_peer_id)
             self._teardown = True
         else:
             logging.warning("[Peer] %s got unexpected request of type %s. Will do nothing.", self.own_peer_id, req.req_type)
 
+    def answer_fp_req(self, req_id, mtype, data):
+        msg = PFDataMsg(req_id, mtype, data)
+        self._answers[req_id] = msg
+        self.send_to_function_party(msg)
+
+    def answer_gram_reqs(self):
+        # gram parts are handed out as soon as they are ready
+        while self._waiting_gram_reqs and self._pgrams:
+            mtype, peergram = self._pgrams.popleft()
+            req_id = self._waiting_gram_reqs.popleft()
+            if req_id in self._req_arrivals:
+                tracing.interval('gram_wait', self.own_peer_id, self._req_arrivals.pop(req_id), tracing.now(),
+                                 request_id=req_id, pairing_id='-'.join(peergram.pairing_id))
+            self.answer_fp_req(req_id, mtype, peergram)
+
+    def add_peergram(self, mtype, pairing_id, component, unmasker):
+        self._pgrams.append((mtype, PeerGram(pairing_id, component, unmasker)))
+        self.answer_gram_reqs()
+
     def answer_userdefreq(self, req):
         pass
 
     
 
+    @tracing.traced('handle_msg', lambda sender, msg: {'sender': sender, **tracing.msg_args(msg)})
     def handle_msg(self, sender, msg):
         peer = sender
         if self._still_waiting[peer]:
             if msg.msg_type == PPMsgType.AliceMasked:
                 logging.debug("[Peer] %s got data from ALICE %s", self.own_peer_id, peer)
                 pairing_id = (peer, self.own_peer_id)
-                component = msg.masked_data @ np.transpose(self.__data)
-                unmasker = msg.partial_unmasker @ np.transpose(self.__masker)
-                peergram = PeerGram(pairing_id, component, unmasker)
-                mtype = MsgType.BobGram
-                self._pgrams.append((mtype, peergram))
+                compute = lambda: (msg.masked_data @ np.transpose(self.__data), msg.partial_unmasker @ np.transpose(self.__masker))
+                self.run_task(compute, lambda result: self.add_peergram(MsgType.BobGram, pairing_id, *result), 'bob', pairing_id)
                 self._still_waiting[peer] = False
             elif msg.msg_type == PPMsgType.BobMasked:
                 logging.debug("[Peer] %s got data from BOB %s", self.own_peer_id, peer)
                 pairing_id = (self.own_peer_id, peer)
-                component = self.__masker @ np.transpose(msg.masked_data)
-                unmasker = 1.0/self.__alpha
-                peergram = PeerGram(pairing_id, component, unmasker)
-                mtype = MsgType.AliceGram
-                self._pgrams.append((mtype, peergram))
+                compute = lambda: self.__masker @ np.transpose(msg.masked_data)
+                self.run_task(compute, lambda component: self.add_peergram(MsgType.AliceGram, pairing_id, component, 1.0/self.__alpha), 'alice', pairing_id)
                 self._still_waiting[peer] = False
             elif msg.msg_type == PPMsgType.Request:
                 logging.info("[Peer] %s got resend request from %s. Will resend data.", self.own_peer_id, peer)
@@ -155,6 +237,7 @@ class ESCAPEDPeer():
                 if waiting:
                     msg = PPMsg(PPMsgType.Request)
                     self.send_to_peer(msg, peer)
+                    metrics.inc('peer_resends_total', peer=self.own_peer_id, to=peer)
                     logging.info("[Peer] %s Timeout. Resend request to peer %s", self.own_peer_id, peer)
         self._last_timeout_check = cur_time
 
@@ -185,4 +268,8 @@ class ESCAPEDPeer():
     def teardown(self):
         pass
 
+    def wake(self):
+        # called from worker threads when a result is ready
+        pass
+
 
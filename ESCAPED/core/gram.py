@@ -0,0 +1,114 @@
+import math
+import numpy as np
+
+# The N x N dot product is assembled block by block: every pairwise block is written
+# straight into one preallocated array, optionally a memory-mapped .npy file, and the
+# mirrored block of the symmetric matrix is filled by a transposed assignment.
+# Diagonal blocks can also come as packed upper triangles, row after row.
+
+
+def pack_triangle(a):
+    n = a.shape[0]
+    packed = np.empty(n*(n+1)//2, dtype=a.dtype)
+    pos = 0
+    for i in range(n):
+        packed[pos:pos+n-i] = a[i, i:]
+        pos += n-i
+    return packed
+
+def unpack_triangle(packed, out):
+    pos = 0
+    for i in range(out.shape[0]):
+        row = packed[pos:pos+out.shape[0]-i]
+        out[i, i:] = row
+        out[i:, i] = row
+        pos += len(row)
+    return out
+
+def triangle_size(length):
+    return (math.isqrt(8*length + 1) - 1) // 2
+
+
+def _same_view(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    return a.__array_interface__['data'][0] == b.__array_interface__['data'][0] \
+        and a.shape == b.shape and a.strides == b.strides and a.dtype == b.dtype
+
+
+class Gram():
+
+    def __init__(self, sizes, path=None, dtype=np.float64):
+        self.peers = list(sizes)
+        self.sizes = dict(sizes)
+        bounds = np.cumsum([0] + [self.sizes[p] for p in self.peers])
+        self._slices = {p: slice(int(bounds[i]), int(bounds[i+1])) for i, p in enumerate(self.peers)}
+        shape = (int(bounds[-1]),) * 2
+        if path:
+            self.array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        else:
+            self.array = np.empty(shape, dtype=dtype)
+
+    def put(self, p1, p2, *parts):
+        # the parts of a block are summed in place
+        block = self.block(p1, p2)
+        if p1 == p2 and np.ndim(parts[0]) == 1:
+            unpack_triangle(parts[0], block)
+            return
+        # a part that was streamed into place is the sum's starting point
+        in_place = [i for i, part in enumerate(parts) if _same_view(block, part)]
+        if in_place:
+            parts = [parts[in_place[0]]] + [part for i, part in enumerate(parts) if i != in_place[0]]
+        else:
+            np.copyto(block, parts[0])
+        for part in parts[1:]:
+            np.add(block, part, out=block)
+        if p1 != p2:
+            self.array[self._slices[p2], self._slices[p1]] = block.T
+
+    def block(self, p1, p2):
+        return self.array[self._slices[p1], self._slices[p2]]
+
+    def holds(self, arr):
+        # whether arr is a view into the dot product
+        start = self.array.__array_interface__['data'][0]
+        return start <= np.asarray(arr).__array_interface__['data'][0] < start + self.array.nbytes
+
+    def view(self, peers):
+        return GramView(peers, self.sizes, self.block)
+
+    def flush(self):
+        if isinstance(self.array, np.memmap):
+            self.array.flush()
+
+
+class GramView():
+
+    # the dot product restricted to some peers, blocks are only fetched when accessed
+
+    def __init__(self, peers, sizes, block):
+        self.peers = list(peers)
+        self.sizes = {p: sizes[p] for p in self.peers}
+        self._block = block
+        n = sum(self.sizes.values())
+        self.shape = (n, n)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def block(self, p1, p2):
+        return self._block(p1, p2)
+
+    def rows(self, peer):
+        return np.concatenate([self.block(peer, p2) for p2 in self.peers], axis=1)
+
+    def materialize(self, path=None):
+        first = self.block(self.peers[0], self.peers[0])
+        gram = Gram(self.sizes, path, first.dtype)
+        for i, p1 in enumerate(self.peers):
+            for p2 in self.peers[i:]:
+                gram.put(p1, p2, self.block(p1, p2))
+        return gram.array
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self.materialize()
+        return arr if dtype is None else arr.astype(dtype, copy=False)
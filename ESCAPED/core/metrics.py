@@ -0,0 +1,167 @@
+import time
+import weakref
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# Counters, gauges and histograms of one process. Nothing is recorded until enable() is called,
+# every update is a single flag check before that. Values are pulled with snapshot() or served
+# in the Prometheus text format by serve().
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+enabled = False
+_lock = Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_collectors = []
+
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+def inc(name, value=1, **labels):
+    if not enabled:
+        return
+    key = _series(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    if not enabled:
+        return
+    with _lock:
+        _gauges[_series(name, labels)] = value
+
+def observe(name, value, **labels):
+    if not enabled:
+        return
+    key = _series(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)}
+        hist['count'] += 1
+        hist['sum'] += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                hist['buckets'][i] += 1
+                break
+
+@contextmanager
+def _timing(name, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+@contextmanager
+def _nothing():
+    yield
+
+def timer(name, **labels):
+    return _timing(name, labels) if enabled else _nothing()
+
+def timed_iter(iterable, name, **labels):
+    # observes the time spent producing all items, e.g. the frames of an encoded message
+    if not enabled:
+        return iterable
+    def timed():
+        total = 0.0
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                break
+            finally:
+                total += time.perf_counter() - start
+            yield item
+        observe(name, total, **labels)
+    return timed()
+
+def add_collector(method):
+    """Registers a bound method that sets gauges whenever a snapshot is taken. Its object is not kept alive."""
+    _collectors.append(weakref.WeakMethod(method))
+
+
+def snapshot():
+    if enabled:
+        for ref in list(_collectors):
+            collect = ref()
+            if collect is None:
+                _collectors.remove(ref)
+            else:
+                collect()
+    with _lock:
+        histograms = {}
+        for key, hist in _histograms.items():
+            cumulative, buckets = 0, {}
+            for bound, count in zip(BUCKETS, hist['buckets']):
+                cumulative += count
+                buckets[bound] = cumulative
+            histograms[key] = {'count': hist['count'], 'sum': hist['sum'], 'buckets': buckets}
+        return {'counters': dict(_counters), 'gauges': dict(_gauges), 'histograms': histograms}
+
+def prometheus_text():
+    snap = snapshot()
+    lines = []
+    for kind, series in (('counter', snap['counters']), ('gauge', snap['gauges'])):
+        for name in sorted({key.split('{')[0] for key in series}):
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{key} {value}' for key, value in sorted(series.items()) if key.split('{')[0] == name)
+    for name in sorted({key.split('{')[0] for key in snap['histograms']}):
+        lines.append(f'# TYPE {name} histogram')
+        for key, hist in sorted(snap['histograms'].items()):
+            base, _, labels = key.partition('{')
+            if base != name:
+                continue
+            labels = labels.rstrip('}')
+            for bound, count in hist['buckets'].items():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{{labels + "," if labels else ""}le="{le}"}} {count}')
+            suffix = '{' + labels + '}' if labels else ''
+            lines.append(f'{name}_sum{suffix} {hist["sum"]}')
+            lines.append(f'{name}_count{suffix} {hist["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port, host='127.0.0.1'):
+    """Enables the metrics and serves them for Prometheus on http://host:port/metrics."""
+    enable()
+    server = ThreadingHTTPServer((host, port), _Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
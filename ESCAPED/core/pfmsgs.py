@@ -33,6 +33,7 @@ class PFMsg():
 class PFRequestMsg(PFMsg):
     req_type: ReqType = None
     spec: Any = None
+    ack: int = 0 # all requests below this id have been answered
 
 @dataclass
 class PFDataMsg(PFMsg):
@@ -0,0 +1,30 @@
+import numpy as np
+
+# dtype modes as (precision of the peers and on the wire, precision of the dot product at the function party)
+DTYPE_MODES = {
+    'float64': (np.float64, np.float64),
+    'float32': (np.float32, np.float32),
+    'mixed': (np.float32, np.float64),
+}
+
+
+def set_dtype_mode(mode, peer_cls, fp_cls):
+    peer_cls.DTYPE, fp_cls.DTYPE = DTYPE_MODES[mode]
+
+
+def accuracy_report(dot_product, data, rtol=1e-05, atol=1e-08, block_rows=1024):
+    """Compares a dot product computed by ESCAPED to the plaintext reference data @ data.T,
+    which is computed in float64 a block of rows at a time."""
+    data = np.asarray(data, dtype=np.float64)
+    max_abs = max_ref = 0.0
+    close = True
+    for start in range(0, data.shape[0], block_rows):
+        ref = data[start:start+block_rows] @ data.T
+        dp = np.asarray(dot_product[start:start+block_rows], dtype=np.float64)
+        max_abs = max(max_abs, float(np.abs(dp - ref).max(initial=0)))
+        max_ref = max(max_ref, float(np.abs(ref).max(initial=0)))
+        close = close and bool(np.isclose(dp, ref, rtol=rtol, atol=atol).all())
+    return {'dtype': str(np.asarray(dot_product[:0]).dtype),
+            'max_abs_error': max_abs,
+            'max_rel_error': max_abs / max_ref if max_ref else 0.0,
+            'allclose': close}
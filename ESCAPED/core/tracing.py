@@ -0,0 +1,132 @@
+import functools
+import itertools
+import json
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+# Spans of a run in the Chrome trace event format, to be opened in chrome://tracing or Perfetto.
+# Every participant gets a track of its own, spans carry request ids and pairing ids as args.
+# Tracing is off until enable() is called. Timestamps are wall clock based, so the traces of
+# several processes can be merged into one timeline.
+
+enabled = False
+_lock = Lock()
+_events = []
+_tracks = {}
+_ids = itertools.count(1)
+_origin = time.time() - time.perf_counter()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    with _lock:
+        _events.clear()
+        _tracks.clear()
+
+def now():
+    return time.perf_counter()
+
+def _us(t):
+    return (_origin + t) * 1e6
+
+def _tid(party):
+    # called with _lock held
+    if party not in _tracks:
+        _tracks[party] = len(_tracks) + 1
+        _events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': _tracks[party],
+                        'args': {'name': str(party)}})
+    return _tracks[party]
+
+def _args(args):
+    return {k: v if isinstance(v, (int, float, bool, type(None))) else str(v) for k, v in args.items()}
+
+
+def complete(name, party, start, end, **args):
+    if not enabled:
+        return
+    event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'ts': _us(start), 'dur': (end - start) * 1e6, 'args': _args(args)}
+    with _lock:
+        _events.append({**event, 'tid': _tid(party)})
+
+def interval(name, party, start, end, **args):
+    # intervals may overlap on one track, e.g. the dwell times of messages in a mailbox
+    if not enabled:
+        return
+    args = _args(args)
+    with _lock: # both ends land in the same export
+        common = {'name': name, 'cat': name, 'id': next(_ids), 'pid': os.getpid(), 'tid': _tid(party)}
+        _events.append({**common, 'ph': 'b', 'ts': _us(start), 'args': args})
+        _events.append({**common, 'ph': 'e', 'ts': _us(end)})
+
+@contextmanager
+def _spanning(name, party, args):
+    start = now()
+    try:
+        yield
+    finally:
+        complete(name, party, start, now(), **args)
+
+@contextmanager
+def _nothing():
+    yield
+
+def span(name, party, **args):
+    return _spanning(name, party, args) if enabled else _nothing()
+
+
+def party_of(obj):
+    # peers are named by their id, the function party by its FP_ID
+    return getattr(obj, 'own_peer_id', None) or getattr(obj, 'FP_ID', type(obj).__name__)
+
+def traced(name, args=None):
+    """Decorates a method of a participant, args maps the call arguments to the span's args."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *a, **kw):
+            if not enabled:
+                return method(self, *a, **kw)
+            with span(name, party_of(self), **(args(*a, **kw) if args else {})):
+                return method(self, *a, **kw)
+        return wrapper
+    return decorate
+
+def msg_args(msg):
+    # request id, message type and pairing id of any message of the protocol
+    args = {}
+    if hasattr(msg, 'request_id'):
+        args['request_id'] = msg.request_id
+    for field in ('msg_type', 'req_type'):
+        value = getattr(msg, field, None)
+        if value is not None:
+            args[field] = getattr(value, 'name', value) # the function party's own messages use plain strings
+    pairing_id = getattr(getattr(msg, 'data', None), 'pairing_id', None)
+    if pairing_id is not None:
+        args['pairing_id'] = '-'.join(pairing_id)
+    return args
+
+
+def events():
+    with _lock:
+        return list(_events)
+
+def export(path):
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events(), 'displayTimeUnit': 'ms'}, f)
+
+def merge(paths, path):
+    """Writes the traces of several processes as one timeline."""
+    merged = []
+    for p in paths:
+        with open(p) as f:
+            merged.extend(json.load(f)['traceEvents'])
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': merged, 'displayTimeUnit': 'ms'}, f)
@@ -1,39 +1,487 @@
-
 import numpy as np
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+# Row blocks can be handed to a pool of worker processes. The gram lives in shared memory,
+# or stays in its .npy file, for the lifetime of the pool. The arrays a task reads and writes
+# are shared for the duration of one computation, workers attach to all of them by name.
+
+_worker = None
+
+def _share(shape, dtype, shms):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    shms[shm.name] = shm
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), ('shm', shm.name, tuple(shape), np.dtype(dtype).str, 0)
+
+def _open(spec):
+    kind, name, shape, dtype, offset = spec
+    if kind == 'file':
+        return None, np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=shape)
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _init_worker(gram_spec):
+    global _worker
+    shm, gram = _open(gram_spec)
+    _worker = kNNOutlierDetection(gram, streaming=True)
+    _worker._gram_shm = shm # keeps the segment mapped
+
+# Workers attach to the gram once, in _init_worker. Only a gram memory-mapped from a .npy file
+# is shared without a copy. Any other gram is copied into shared memory once, and the detector
+# then keeps only that copy, so the caller can drop the original to avoid holding it twice.
+def _work(method, start, stop, *specs):
+    opened = [_open(spec) for spec in specs]
+    getattr(_worker, method)(slice(start, stop), *[arr for _, arr in opened])
+    shms = [shm for shm, _ in opened]
+    del opened # the segments can only be closed once no array refers to them
+    for shm in shms:
+        shm.close()
+
+def _release(shms):
+    for shm in shms.values():
+        shm.close()
+        shm.unlink()
+    shms.clear()
 
 
 class kNNOutlierDetection():
 
-    def __init__(self, gram):
+    # Distances are derived from the gram a block of rows at a time, |x_i - x_j|^2 = G_ii + G_jj - 2 G_ij.
+    # In streaming mode the N x N distance matrix is never kept, only the k_max nearest neighbours,
+    # so the gram may be a memory-mapped array that does not fit into RAM.
+
+    BLOCK_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, gram, k_max=None, streaming=False, workers=0):
+        self.gram = gram
         self.nb_samples = gram.shape[0]
-        diag_helper = np.zeros(gram.shape)
-        diag_helper[:] = gram[np.diag_indices(self.nb_samples)]
-        squared_distances = diag_helper + np.transpose(diag_helper) -2*gram 
-        self.distances = np.sqrt(squared_distances)
-        self.knn = np.argsort(self.distances)
+        self.diag = np.array(np.diagonal(gram), dtype=np.float64)
+        self.distances = None
+        self._pool = None
+        if workers: # workers derive the distances from the gram themselves
+            self._start_pool(workers)
+        elif not streaming:
+            distances = np.empty(gram.shape)
+            for rows in self.row_blocks():
+                distances[rows] = self.block_distances(rows)
+            self.distances = distances
+        self.knn = None
+        self.knn_distances = None
+        if k_max is not None:
+            self.build_index(k_max)
+
+    def _start_pool(self, workers):
+        self._shms = {}
+        gram = self.gram
+        gram_shm = None
+        if isinstance(gram, np.memmap) and gram.filename and gram.flags.c_contiguous:
+            gram_spec = ('file', gram.filename, gram.shape, gram.dtype.str, gram.offset)
+        else:
+            gram_shms = {}
+            shared, gram_spec = _share(gram.shape, gram.dtype, gram_shms)
+            shared[:] = gram
+            self.gram = shared # the only copy of the gram kept from here on
+            gram_shm = self._gram_shm = gram_shms.popitem()[1] # closed after self.gram is gone
+        self._pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(gram_spec,))
+        self._finalizer = weakref.finalize(self, self._shutdown, self._pool, self._shms, gram_shm)
+
+    @staticmethod
+    def _shutdown(pool, shms, gram_shm=None):
+        pool.shutdown()
+        _release(shms)
+        if gram_shm is not None:
+            gram_shm.unlink() # the mapping stays valid while the detector uses it
+
+    def close(self):
+        if self._pool:
+            self._finalizer()
+            self._pool = None
+
+    def _for_row_blocks(self, method, width, inputs, outputs):
+        # method fills the outputs, given as (shape, dtype), block of rows by block of rows,
+        # on the workers if there are any
+        if not self._pool:
+            results = [np.empty(shape, dtype=dtype) for shape, dtype in outputs]
+            for rows in self.row_blocks(width):
+                getattr(self, method)(rows, *inputs, *results)
+            return results
+        shms = {}
+        shared_outputs = []
+        try:
+            specs = []
+            for arr in inputs:
+                shared, spec = _share(arr.shape, arr.dtype, shms)
+                shared[:] = arr
+                specs.append(spec)
+            for shape, dtype in outputs:
+                shared, spec = _share(shape, dtype, shms)
+                shared_outputs.append(shared)
+                specs.append(spec)
+            shared = None
+            futures = [self._pool.submit(_work, method, rows.start, rows.stop, *specs) for rows in self.row_blocks(width)]
+            for future in futures:
+                future.result()
+            return [arr.copy() for arr in shared_outputs]
+        finally:
+            shared = shared_outputs = None
+            _release(shms)
+
+    def row_blocks(self, width=None):
+        # blocks of rows whose float64 temporaries of the given width fit into BLOCK_BYTES
+        width = self.nb_samples if width is None else width
+        nb_rows = max(1, self.BLOCK_BYTES // (8 * max(1, width)))
+        for start in range(0, self.nb_samples, nb_rows):
+            yield slice(start, min(start+nb_rows, self.nb_samples))
+
+    def block_distances(self, rows):
+        if self.distances is not None:
+            return self.distances[rows]
+        squared = np.array(self.gram[rows], dtype=np.float64)
+        squared *= -2
+        squared += self.diag[rows, None]
+        squared += self.diag[None, :]
+        np.maximum(squared, 0, out=squared) # rounding must not turn distances of duplicates into nan
+        return np.sqrt(squared, out=squared)
+
+    def pair_distances(self, a, b):
+        if self.distances is not None:
+            return self.distances[a, b]
+        squared = self.diag[a] + self.diag[b] - 2*np.asarray(self.gram[a, b], dtype=np.float64)
+        return np.sqrt(np.maximum(squared, 0))
+
+    def build_index(self, k_max):
+        # only the k_max+1 nearest samples (the sample itself first) are selected and sorted, a block of rows at a time
+        shape = (self.nb_samples, min(k_max+1, self.nb_samples))
+        self.knn, self.knn_distances = self._for_row_blocks('_select_neighbors', None, [], [(shape, np.intp), (shape, np.float64)])
+
+    def _select_neighbors(self, rows, knn, knn_distances):
+        dists = self.block_distances(rows)
+        nb_cols = knn.shape[1]
+        idx = np.argpartition(dists, nb_cols-1, axis=1)[:, :nb_cols]
+        nearest = np.take_along_axis(dists, idx, axis=1)
+        order = np.argsort(nearest, axis=1)
+        knn[rows] = np.take_along_axis(idx, order, axis=1)
+        knn_distances[rows] = np.take_along_axis(nearest, order, axis=1)
+
+    def neighbors(self, k):
+        if self.knn is None or self.knn.shape[1] < k+1:
+            self.build_index(k)
+        return self.knn[:, :k+1], self.knn_distances[:, :k+1]
 
     def knn_simple_score(self, k):
-        return self.distances[np.arange(self.nb_samples), self.knn[:,k]]
+        _, knn_dists = self.neighbors(k)
+        return knn_dists[:, k]
 
     def knn_weighted_score(self, k):
-        return self.distances[np.arange(self.nb_samples),self.knn[:,1:k+1].T].T.sum(axis=1)
+        _, knn_dists = self.neighbors(k)
+        return knn_dists[:, 1:k+1].sum(axis=1)
 
     def ldof_score(self, k):
-        nrange = np.arange(1, k+1, 1)
-        innercombinations = [(n1, n2) for n1 in nrange for n2 in nrange if n1<n2] 
-        innerdists = np.zeros(self.nb_samples)
-        for i in np.arange(self.nb_samples):
-            innerdists[i] = sum(self.distances[self.knn[i,n1], self.knn[i,n2]] for (n1,n2) in innercombinations)/(k*(k-1)/2) 
-        knndists = self.distances[np.arange(self.nb_samples),self.knn[:,1:k+1].T].T.sum(axis=1) / k
+        _, knn_dists = self.neighbors(k)
+        knndists = knn_dists[:, 1:k+1].sum(axis=1) / k
+        innerdists = self._inner_distance_sums(k)[:, k-1] / (k*(k-1)/2)
         return knndists/innerdists
- 
+
+    def _inner_distance_sums(self, k_max):
+        # column k-1 holds the sum of the distances between all pairs of the k nearest neighbours
+        knn, _ = self.neighbors(k_max)
+        return self._for_row_blocks('_inner_sums', k_max*k_max, [knn], [((self.nb_samples, k_max), np.float64)])[0]
+
+    def _inner_sums(self, rows, knn, sums):
+        k_max = sums.shape[1]
+        neighbors = knn[rows, 1:]
+        pairs = self.pair_distances(neighbors[:, :, None], neighbors[:, None, :])
+        np.cumsum(np.triu(pairs, 1).sum(axis=1), axis=1, out=sums[rows])
+
     def lof_score(self, k):
-        lrd_invs_tk = np.zeros(self.nb_samples)
-        lof = np.zeros(self.nb_samples)
-        for i in np.arange(self.nb_samples):
-            lrd_invs_tk[i] = sum(max(self.distances[n, self.knn[n,k]], self.distances[i,n]) for n in self.knn[i, 1:k+1])
-        for i in np.arange(self.nb_samples): 
-            lof[i] = sum(lrd_invs_tk[i]/lrd_invs_tk[n] for n in self.knn[i,1:k+1])/k
-        return lof
+        knn, knn_dists = self.neighbors(k)
+        reach_dists = np.maximum(knn_dists[knn[:, 1:], k], knn_dists[:, 1:])
+        lrd_invs_tk = reach_dists.sum(axis=1)
+        return (lrd_invs_tk[:, None] / lrd_invs_tk[knn[:, 1:]]).sum(axis=1) / k
+
+    def score_sweep(self, ks, algorithms=('knn', 'wknn', 'lof', 'ldof')):
+        """Scores of all algorithms for every k in ks, as {algorithm: {k: scores}},
+        computed from one neighbour index for the largest k."""
+        k_max = max(ks)
+        self.neighbors(k_max)
+        inner_sums = self._inner_distance_sums(k_max) if 'ldof' in algorithms else None
+        scores = {algo: {} for algo in algorithms}
+        for k in ks:
+            _, knn_dists = self.neighbors(k)
+            if 'knn' in algorithms:
+                scores['knn'][k] = knn_dists[:, k]
+            if 'wknn' in algorithms:
+                scores['wknn'][k] = knn_dists[:, 1:k+1].sum(axis=1)
+            if 'lof' in algorithms:
+                scores['lof'][k] = self.lof_score(k)
+            if 'ldof' in algorithms:
+                scores['ldof'][k] = (knn_dists[:, 1:k+1].sum(axis=1) / k) / (inner_sums[:, k-1] / (k*(k-1)/2))
+        return scores
+
+
+class _GrowingGram():
+
+    # the initial gram followed by the gram rows of samples added later,
+    # G[a, b] with a >= b is read from the rows that came with sample a
+
+    def __init__(self, gram):
+        self._blocks = [gram]
+        self._offsets = [0]
+        self.shape = gram.shape
+
+    def append(self, rows):
+        self._offsets.append(self.shape[0])
+        self._blocks.append(rows)
+        self.shape = (rows.shape[1], rows.shape[1])
+
+    def __getitem__(self, key):
+        if len(self._blocks) == 1:
+            return self._blocks[0][key]
+        if not isinstance(key, tuple):
+            return self._rows(key)
+        a, b = np.broadcast_arrays(*key)
+        later, earlier = np.maximum(a, b), np.minimum(a, b)
+        block_ids = np.searchsorted(self._offsets, later, side='right') - 1
+        values = np.empty(later.shape)
+        for i, (offset, block) in enumerate(zip(self._offsets, self._blocks)):
+            sel = block_ids == i
+            values[sel] = block[later[sel] - offset, earlier[sel]]
+        return values
+
+    def _rows(self, key):
+        # whole rows, the columns of each block of samples added later are mirrored from its rows
+        rows = np.arange(self.shape[0])[key]
+        out = np.empty(rows.shape + (self.shape[1],))
+        flat = out.reshape(-1, self.shape[1])
+        flat_rows = rows.reshape(-1)
+        for offset, block in zip(self._offsets, self._blocks):
+            end = offset + block.shape[0]
+            own = (flat_rows >= offset) & (flat_rows < end)
+            flat[own, :end] = block[flat_rows[own] - offset]
+            earlier = flat_rows < offset
+            flat[earlier, offset:end] = np.asarray(block[:, flat_rows[earlier]]).T
+        return out
+
+
+class IncrementalOutlierDetection(kNNOutlierDetection):
+
+    # Keeps the neighbour lists and all four scores for one k up to date while samples are added.
+    # Besides reading the new gram rows once, an update only touches the samples whose neighbours
+    # or scores change: the samples that have a given one among their k nearest neighbours are
+    # kept in an inverse index, and the arrays with a row per sample grow geometrically.
+
+    ALGORITHMS = ('knn', 'wknn', 'lof', 'ldof')
+
+    def __init__(self, gram, k):
+        super().__init__(gram, streaming=True)
+        self.k = k
+        self.gram = _GrowingGram(gram)
+        self._buffers = {'diag': self.diag}
+        knn, knn_dists = self.neighbors(k)
+        self._buffers['lrd_invs'] = np.maximum(knn_dists[knn[:, 1:], k], knn_dists[:, 1:]).sum(axis=1)
+        for algo, scores in self.score_sweep([k], self.ALGORITHMS).items():
+            self._buffers[algo] = np.array(scores[k], dtype=np.float64) # knn scores are views of the index
+        self._resize(self.nb_samples)
+
+    def build_index(self, k_max):
+        # an index for a larger k replaces the one for self.k and is kept up to date from then on
+        super().build_index(max(k_max, self.k))
+        self._buffers['neighbors'], self._buffers['neighbor_distances'] = self.knn, self.knn_distances
+        self._reverse = [set() for _ in range(self.nb_samples)]
+        self._update_reverse_neighbors(np.arange(self.nb_samples))
+
+    def _resize(self, nb_samples):
+        for name, buf in self._buffers.items():
+            if len(buf) < nb_samples:
+                grown = np.empty((max(nb_samples, 2*len(buf)),) + buf.shape[1:], dtype=buf.dtype)
+                grown[:self.nb_samples] = buf[:self.nb_samples]
+                self._buffers[name] = grown
+        views = {name: buf[:nb_samples] for name, buf in self._buffers.items()}
+        self.diag = views.pop('diag')
+        self.knn = views.pop('neighbors')
+        self.knn_distances = views.pop('neighbor_distances')
+        self._lrd_invs = views.pop('lrd_invs')
+        self.scores = views
+        self._reverse.extend(set() for _ in range(nb_samples - self.nb_samples))
+        self.nb_samples = nb_samples
+
+    def add_samples(self, gram_rows):
+        """Adds samples given by their rows of the gram, i.e. their dot products with all existing
+        samples followed by those among themselves. Returns the indices whose scores were updated."""
+        gram_rows = np.asarray(gram_rows, dtype=np.float64)
+        k = self.k
+        nb_old, nb_new = self.nb_samples, gram_rows.shape[0]
+        new_ids = np.arange(nb_old, nb_old+nb_new)
+        self._resize(nb_old + nb_new)
+        self.diag[new_ids] = gram_rows[np.arange(nb_new), new_ids]
+        squared = self.diag[new_ids, None] + self.diag[None, :] - 2*gram_rows
+        dists = np.sqrt(np.maximum(squared, 0))
+        self.gram.append(gram_rows)
+
+        # neighbours of the new samples
+        nb_cols = self.knn.shape[1]
+        self.knn[new_ids], self.knn_distances[new_ids] = self._nearest(np.broadcast_to(np.arange(self.nb_samples), dists.shape), dists, nb_cols)
+        self._update_reverse_neighbors(new_ids)
+
+        # existing samples that get a new sample among their nearest neighbours
+        cross = dists[:, :nb_old].T
+        entered = np.flatnonzero((cross < self.knn_distances[:nb_old, -1, None]).any(axis=1))
+        before = self.knn[entered, 1:k+1]
+        candidates = np.concatenate([self.knn[entered], np.broadcast_to(new_ids, (len(entered), nb_new))], axis=1)
+        candidate_dists = np.concatenate([self.knn_distances[entered], cross[entered]], axis=1)
+        self.knn[entered], self.knn_distances[entered] = self._nearest(candidates, candidate_dists, nb_cols)
+        self._update_reverse_neighbors(entered, before)
+
+        # knn, wknn and ldof only depend on the own neighbours, lof also on those of the neighbours
+        changed = np.concatenate([entered, new_ids])
+        self.scores['knn'][changed] = self.knn_distances[changed, k]
+        self.scores['wknn'][changed] = self.knn_distances[changed, 1:k+1].sum(axis=1)
+        self.scores['ldof'][changed] = self._ldof_rows(changed)
+        lrd_changed = self._with_reverse_neighbors(changed)
+        self._lrd_invs[lrd_changed] = np.maximum(self.knn_distances[self.knn[lrd_changed, 1:k+1], k],
+                                                  self.knn_distances[lrd_changed, 1:k+1]).sum(axis=1)
+        lof_changed = self._with_reverse_neighbors(lrd_changed)
+        self.scores['lof'][lof_changed] = (self._lrd_invs[lof_changed, None] / self._lrd_invs[self.knn[lof_changed, 1:k+1]]).sum(axis=1) / k
+        return lof_changed
+
+    @staticmethod
+    def _nearest(idx, dists, nb_cols):
+        part = np.argpartition(dists, nb_cols-1, axis=1)[:, :nb_cols]
+        nearest = np.take_along_axis(dists, part, axis=1)
+        order = np.argsort(nearest, axis=1)
+        return np.take_along_axis(np.take_along_axis(idx, part, axis=1), order, axis=1), np.take_along_axis(nearest, order, axis=1)
+
+    def _update_reverse_neighbors(self, rows, before=None):
+        # moves rows in the inverse index from their k nearest neighbours before to those they have now
+        after = self.knn[rows, 1:self.k+1].tolist()
+        before = before.tolist() if before is not None else [()] * len(after)
+        for row, old, new in zip(rows.tolist(), before, after):
+            old, new = set(old), set(new)
+            for sample in old - new:
+                self._reverse[sample].discard(row)
+            for sample in new - old:
+                self._reverse[sample].add(row)
+
+    def _with_reverse_neighbors(self, samples):
+        # the samples and all samples that have one of them among their k nearest neighbours
+        found = set(samples.tolist())
+        for sample in samples.tolist():
+            found |= self._reverse[sample]
+        return np.array(sorted(found), dtype=np.intp)
+
+    def _ldof_rows(self, rows):
+        k = self.k
+        neighbors = self.knn[rows, 1:k+1]
+        pairs = self.pair_distances(neighbors[:, :, None], neighbors[:, None, :])
+        innerdists = np.triu(pairs, 1).sum(axis=(1, 2)) / (k*(k-1)/2)
+        return (self.knn_distances[rows, 1:k+1].sum(axis=1) / k) / innerdists
+
+
+class ApproximatekNNOutlierDetection(kNNOutlierDetection):
+
+    # Candidate neighbours are taken from a Nystroem embedding of the gram, which only needs the gram
+    # rows of a few landmark samples. The embedded samples are clustered by a few k-means iterations
+    # and each sample is compared to the members of its `probes` closest clusters. Exact distances
+    # are computed from the gram for these candidates only, about N * probes * N/clusters of them.
+
+    def __init__(self, gram, k_max=None, rank=32, clusters=None, probes=4, iterations=5, seed=None):
+        super().__init__(gram, streaming=True)
+        self.rank = min(rank, self.nb_samples)
+        self.clusters = min(clusters or int(np.sqrt(self.nb_samples)), self.nb_samples)
+        self.probes = min(probes, self.clusters)
+        self.iterations = iterations
+        self._rng = np.random.default_rng(seed)
+        self._embedding = None
+        self._probed = None
+        if k_max is not None:
+            self.build_index(k_max)
+
+    def embedding(self):
+        if self._embedding is None:
+            landmarks = np.sort(self._rng.choice(self.nb_samples, self.rank, replace=False))
+            cols = np.asarray(self.gram[landmarks], dtype=np.float64).T # the gram is symmetric
+            vals, vecs = np.linalg.eigh(cols[landmarks])
+            keep = vals > vals.max() * 1e-10
+            self._embedding = cols @ (vecs[:, keep] / np.sqrt(vals[keep]))
+        return self._embedding
+
+    def _closest_centroids(self, emb, centroids, nb):
+        closest = np.empty((len(emb), nb), dtype=np.intp)
+        sq_norms = (centroids**2).sum(axis=1)
+        for rows in self.row_blocks(len(centroids)):
+            dists = sq_norms[None, :] - 2 * emb[rows] @ centroids.T
+            part = np.argpartition(dists, nb-1, axis=1)[:, :nb] if nb < len(centroids) else np.broadcast_to(np.arange(nb), (len(dists), nb))
+            order = np.argsort(np.take_along_axis(dists, part, axis=1), axis=1)
+            closest[rows] = np.take_along_axis(part, order, axis=1)
+        return closest
+
+    def probed_clusters(self):
+        # the clusters every sample is compared to, its own cluster first
+        if self._probed is None:
+            emb = self.embedding()
+            centroids = emb[self._rng.choice(self.nb_samples, self.clusters, replace=False)]
+            for _ in range(self.iterations):
+                labels = self._closest_centroids(emb, centroids, 1)[:, 0]
+                counts = np.bincount(labels, minlength=self.clusters)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, emb)
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled, None]
+            self._probed = self._closest_centroids(emb, centroids, self.probes)
+        return self._probed
 
+    def build_index(self, k_max):
+        nb_cols = min(k_max+1, self.nb_samples)
+        # the probed clusters hold at least k_max+1 samples on average, the clustering is redone with fewer of them otherwise
+        clusters = max(1, min(self.clusters, self.nb_samples * self.probes // nb_cols))
+        if clusters != self.clusters:
+            self.clusters = clusters
+            self.probes = min(self.probes, clusters)
+            self._probed = None
+        probed = self.probed_clusters()
+        labels = probed[:, 0]
+        sizes = np.bincount(labels, minlength=self.clusters)
+        # samples whose probed clusters are too small anyway are compared to all samples
+        short = sizes[probed].sum(axis=1) < nb_cols
+        self.knn = np.zeros((self.nb_samples, nb_cols), dtype=np.intp) # every row is filled with real candidates below
+        self.knn_distances = np.full((self.nb_samples, nb_cols), np.inf)
+        self.nb_candidates = 0
+        members_of = np.split(np.argsort(labels, kind='stable'), np.cumsum(sizes)[:-1])
+        by_cluster = np.argsort(probed.ravel(), kind='stable')
+        queries_of = np.split(by_cluster // self.probes, np.cumsum(np.bincount(probed.ravel(), minlength=self.clusters))[:-1])
+        for members, queries in zip(members_of, queries_of):
+            queries = queries[~short[queries]]
+            if not len(members) or not len(queries):
+                continue
+            self.nb_candidates += len(members) * len(queries)
+            dists = self.pair_distances(queries[:, None], members[None, :])
+            idx = np.concatenate([self.knn[queries], np.broadcast_to(members, dists.shape)], axis=1)
+            dists = np.concatenate([self.knn_distances[queries], dists], axis=1)
+            part = np.argpartition(dists, nb_cols-1, axis=1)[:, :nb_cols]
+            nearest = np.take_along_axis(dists, part, axis=1)
+            order = np.argsort(nearest, axis=1)
+            self.knn[queries] = np.take_along_axis(np.take_along_axis(idx, part, axis=1), order, axis=1)
+            self.knn_distances[queries] = np.take_along_axis(nearest, order, axis=1)
+        short = np.flatnonzero(short)
+        nb_block = max(1, self.BLOCK_BYTES // (8 * self.nb_samples))
+        for start in range(0, len(short), nb_block):
+            self._select_neighbors(short[start:start+nb_block], self.knn, self.knn_distances)
+        self.nb_candidates += len(short) * self.nb_samples
+        self.nb_candidates /= self.nb_samples
 
+    def recall(self, k, nb_rows=1000):
+        """Share of the exact k nearest neighbours found, estimated on up to nb_rows random samples."""
+        _, knn_dists = self.neighbors(k)
+        rows = np.sort(self._rng.choice(self.nb_samples, min(nb_rows, self.nb_samples), replace=False))
+        found = 0
+        nb_block = max(1, self.BLOCK_BYTES // (8 * self.nb_samples))
+        for start in range(0, len(rows), nb_block):
+            sample = rows[start:start+nb_block]
+            exact = np.partition(self.block_distances(sample), k, axis=1)[:, k]
+            found += (knn_dists[sample, 1:k+1] <= exact[:, None]).sum()
+        return {'k': k,
+                'recall': float(found / (len(rows) * k)),
+                'samples_evaluated': len(rows),
+                'candidates_per_sample': float(self.nb_candidates)}
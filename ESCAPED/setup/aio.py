@@ -0,0 +1,320 @@
+import asyncio
+import contextlib
+import logging
+import struct
+from functools import partial
+from threading import Thread, Lock
+
+from ESCAPED.core import metrics, tracing
+from ESCAPED.setup.connector import Connserver, Message
+from ESCAPED.setup.session import Session
+from ESCAPED.setup.peer import Peer
+from ESCAPED.setup.function_party import FP
+
+# asyncio variants of the connector and of the participants' transport hooks.
+# They speak the same wire protocol as the selector based classes, so both can be mixed.
+# Participants run as tasks that step the state machines of core/ from the event loop, so a
+# single loop thread carries a connector and many participants without a thread for each.
+
+_shared_loop = None
+_shared_loop_lock = Lock()
+
+def shared_loop():
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = asyncio.new_event_loop()
+            Thread(target=_shared_loop.run_forever, daemon=True).start()
+    return _shared_loop
+
+
+class _Paused():
+
+    # stands in for a paused connection in Mailbox.waiting
+
+    def __init__(self):
+        self.resumed = asyncio.Event()
+
+    def resume(self):
+        self.resumed.set()
+
+
+class AsyncConnserver(Connserver):
+
+    HDR = struct.Struct("!I")
+
+    def __init__(self, connaddr, client_ids):
+        super().__init__(connaddr, client_ids)
+        self.sel.close() # sockets are served by the event loop instead
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def start(self, loop=None):
+        return asyncio.run_coroutine_threadsafe(self.serve(), loop or shared_loop())
+
+    async def serve(self):
+        self._clients_running = set(self.client_ids)
+        self._finished = asyncio.Event()
+        self._writers = set()
+        self._pushers = {}
+        servers = [await asyncio.start_server(partial(self._handle, s.getsockname()[1]), sock=s)
+                   for s in [self.lsock, *self.socks.values()]]
+        try:
+            await self._finished.wait()
+        finally:
+            for server in servers:
+                server.close()
+            for pusher in list(self._pushers.values()):
+                pusher.cancel()
+            for writer in list(self._writers):
+                writer.close()
+
+    def _dropout(self, client_id):
+        self._clients_running.discard(client_id)
+        if not self._clients_running:
+            self._finished.set()
+
+    def deliver(self, port, content):
+        metrics.inc('connector_msgs_relayed_total')
+        metrics.inc('connector_bytes_relayed_total', len(content))
+        self.msgbuffers[port].append(content)
+        self._push(port)
+
+    def _push(self, port):
+        # like the selector based sessions, a subscriber gets its messages one at a time,
+        # so a mailbox over its quota keeps holding back its senders
+        if port in self.subscribers and port not in self._pushers and self.msgbuffers[port]:
+            self._pushers[port] = asyncio.ensure_future(self._pusher(port))
+
+    async def _pusher(self, port):
+        outbuf = self.msgbuffers[port]
+        try:
+            while outbuf and port in self.subscribers:
+                writer = self.subscribers[port]
+                self._respond(writer, outbuf.popleft())
+                await writer.drain()
+        except ConnectionError:
+            pass # the session handler cleans up
+        finally:
+            del self._pushers[port]
+
+    def _respond(self, writer, msg):
+        if msg is None:
+            writer.write(Message.EMPTY_MSG)
+        else:
+            writer.write(self.HDR.pack(len(msg)))
+            writer.write(memoryview(msg)) # may be a spilled mmap
+
+    async def _room(self, mailbox):
+        # stop reading from the sender until the destination mailbox has room again
+        while mailbox.full():
+            paused = _Paused()
+            mailbox.waiting.append(paused)
+            await paused.resumed.wait()
+
+    async def _read_content(self, reader, size):
+        # large payloads are spilled like in the selector based connector, see allocate
+        if self.SPILL_THRESHOLD is None or size < self.SPILL_THRESHOLD:
+            return await reader.readexactly(size)
+        buf = self.allocate(size)
+        with memoryview(buf) as view:
+            received = 0
+            while received < size:
+                chunk = await reader.read(min(size - received, Message.MAX_CHUNKSIZE))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(bytes(view[:received]), size)
+                view[received:received+len(chunk)] = chunk
+                received += len(chunk)
+        return buf
+
+    async def _handle(self, port, reader, writer):
+        metrics.inc('connector_connections_accepted_total')
+        self._writers.add(writer)
+        try:
+            code = self.HDR.unpack(await reader.readexactly(self.HDR.size))[0]
+            if code == 0: # client checks its mailbox
+                outbuf = self.msgbuffers[port]
+                self._respond(writer, outbuf.popleft() if outbuf else None)
+            elif code == Message.TEARDOWN:
+                self._dropout((await reader.read()).decode())
+            elif code == Message.SESSION_REQUEST:
+                await self._session(port, reader, writer)
+            elif code == Message.LOOKUP:
+                endpoint = self.endpoints.get(port)
+                self._respond(writer, struct.pack("!H", endpoint[1]) + endpoint[0].encode() if endpoint else None)
+            elif code == Message.REGISTER:
+                endpoint_port = struct.unpack("!H", await reader.readexactly(2))[0]
+                self.endpoints[port] = (writer.get_extra_info('peername')[0], endpoint_port)
+            else:
+                await self._room(self.msgbuffers[port])
+                self.deliver(port, await self._read_content(reader, code))
+            await writer.drain()
+        except asyncio.IncompleteReadError as e:
+            if e.partial: # otherwise the connection was closed between two frames
+                logging.error("[AsyncConnserver]: Exception for %s : %s", writer.get_extra_info('peername'), e)
+        except ConnectionError as e:
+            logging.error("[AsyncConnserver]: Exception for %s : %s", writer.get_extra_info('peername'), e)
+        finally:
+            if self.subscribers.get(port) is writer:
+                del self.subscribers[port]
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _session(self, port, reader, writer):
+        while True:
+            conlen, dst = Session.FRAMEHDR.unpack(await reader.readexactly(Session.FRAMEHDR.size))
+            if dst >= 1024:
+                await self._room(self.msgbuffers[dst])
+            content = await self._read_content(reader, conlen) if conlen else b""
+            if dst == Session.CHECK:
+                outbuf = self.msgbuffers[port]
+                self._respond(writer, outbuf.popleft() if outbuf else None)
+            elif dst == Session.TEARDOWN:
+                self._dropout(bytes(content).decode())
+                return
+            elif dst == Session.SUBSCRIBE:
+                self.subscribers[port] = writer
+                self._push(port)
+            else:
+                self.deliver(dst, content)
+            await writer.drain()
+
+
+class AioSession():
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._receiver = None
+
+    @classmethod
+    async def open(cls, addr, inbox):
+        reader, writer = await asyncio.open_connection(*addr)
+        session = cls(reader, writer)
+        writer.write(Session.SESSION_REQUEST)
+        writer.write(Session.FRAMEHDR.pack(0, Session.SUBSCRIBE))
+        await writer.drain()
+        session._receiver = asyncio.ensure_future(session._receive(inbox))
+        return session
+
+    async def _receive(self, inbox):
+        try:
+            while True:
+                conlen = struct.unpack("!I", await self.reader.readexactly(4))[0]
+                if conlen:
+                    inbox.put_nowait(await self.reader.readexactly(conlen))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # connector closed the session
+
+    def send(self, port, payload):
+        # frames are buffered by the transport until the next drain
+        self.writer.write(Session.FRAMEHDR.pack(len(payload), port))
+        self.writer.write(payload)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def close(self, payload=None):
+        # the payload of a teardown frame tells the connector who is done
+        if payload is not None:
+            self.send(Session.TEARDOWN, payload)
+        self._receiver.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._receiver
+        self.writer.close()
+        with contextlib.suppress(ConnectionError):
+            await self.writer.wait_closed()
+
+
+class AioTransport():
+
+    # replaces the blocking transport hooks of Peer and FP, incoming messages are always pushed
+    # by the connector. The participant is stepped by a task on the event loop, see run(). Frames
+    # sent while handling a message are buffered and drained before the next message is waited
+    # for, and with WORKERS = 0 the matrix products run on the loop thread itself.
+
+    PERSISTENT = False
+    PUSH = False
+    DIRECT = False
+
+    def _open_aio(self, mailbox_addr, loop=None):
+        # the connection is opened by run(), on the loop
+        self._loop = loop or shared_loop()
+        self._mailbox_addr = mailbox_addr
+        self._link = None
+
+    async def _connect(self):
+        self._aio_inbox = asyncio.Queue()
+        self._link = await AioSession.open(self._mailbox_addr, self._aio_inbox)
+
+    def start(self, *args):
+        """Schedules run() on the participant's loop and returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(self.run(*args), self._loop)
+
+    def cooperate(self, *args):
+        # blocking like the cooperate of the other participants, the work is done on the loop
+        return self.start(*args).result()
+
+    def _relay(self, emsg, peer):
+        self._link.send(self._addrs[peer][1], emsg)
+
+    def _check_mailbox(self, block=False):
+        # never blocks the loop, waiting for messages is done by _next_arrivals
+        while not self._aio_inbox.empty():
+            self._accept(self._aio_inbox.get_nowait())
+
+    async def _next_arrivals(self, block):
+        await self._link.drain()
+        if block:
+            with contextlib.suppress(asyncio.TimeoutError):
+                self._accept(await asyncio.wait_for(self._aio_inbox.get(), self.POLL_TIMEOUT))
+        else:
+            await asyncio.sleep(0) # let the other tasks on the loop run
+        self._check_mailbox()
+
+    def wake(self):
+        # called from worker threads
+        self._loop.call_soon_threadsafe(self._aio_inbox.put_nowait, None)
+
+
+class AsyncPeer(AioTransport, Peer):
+
+    def __init__(self, name, connector_addr, data, loop=None):
+        super().__init__(name, connector_addr, data)
+        self._open_aio(self._addrs[self.own_peer_id], loop)
+
+    async def run(self):
+        await self._connect()
+        with tracing.span('cooperate', self.own_peer_id):
+            self.prepare()
+            while not self._teardown:
+                self.collect_results()
+                await self._next_arrivals(block=not self._input_buf)
+                self.dispatch(*(self._input_buf.popleft() if self._input_buf else (None, None)))
+            self.finish()
+        await self._link.close(self.own_peer_id.encode())
+
+    def teardown(self):
+        self._assembler.close() # the link is closed by run()
+
+
+class AsyncFP(AioTransport, FP):
+
+    def __init__(self, connector_addr, loop=None):
+        super().__init__(connector_addr)
+        self._open_aio(self._addrs[self.FP_ID], loop)
+
+    async def run(self, labels=False):
+        await self._connect()
+        with tracing.span('cooperate', self.FP_ID):
+            self.prepare(labels)
+            while not self.queue_empty():
+                await self._next_arrivals(block=len(self._input_buf) == 1 and self.waiting_for_peers())
+                sender, msg = self._input_buf.popleft()
+                self.handle_msg(msg, sender)
+            self.finish()
+        await self._link.close()
+
+    def teardown(self):
+        self._assembler.close() # the link is closed by run()
@@ -4,27 +4,44 @@ from collections import deque
 import socket
 import selectors
 import struct
-import pickle
+
+from ESCAPED.core import codec, metrics, tracing
+from ESCAPED.setup.mailbox import Mailbox, allocate
+
+
+class ConnectionClosed(RuntimeError):
+    pass
 
 
 class Message():
 
     HDRLEN = 4
     EMPTY_MSG = bytearray(4)
-    CHUNKSIZE = 4096
-
-    def __init__(self, selector, sock, addr, outbuf):
+    CHUNKSIZE = 64 * 1024
+    MAX_CHUNKSIZE = 4 * 1024 * 1024
+    TEARDOWN = 1
+    SESSION_REQUEST = 2
+    LOOKUP = 3
+    REGISTER = 4
+
+    def __init__(self, selector, sock, addr, port, server):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self.outbuf = outbuf
-        self._recv_chunks = []
-        self._recv_chunks_size = 0
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self.port = port
+        self.server = server
+        self.outbuf = server.msgbuffers[port]
+        self._recv_chunksize = self.CHUNKSIZE
+        self._send_chunksize = self.CHUNKSIZE
+        self._hdr = bytearray(self.HDRLEN)
+        self._hdr_received = 0
+        self._recv_buffer = None
+        self._recv_received = 0
+        self._send_queue = deque()
         self._content_len = None
         self.content = None
         self.response_created = False
+        self._paused = False
 
     def _set_selector_events_mask(self, mode):
         if mode == "r":
@@ -35,7 +52,32 @@ class Message():
             events = selectors.EVENT_READ | selectors.EVENT_WRITE
         else:
             raise ValueError(f"[Msg]: Invalid events mask mode {mode!r}")
-        self.selector.modify(self.sock, events, data=self)
+        self._watch(events)
+
+    def _watch(self, events):
+        # a connection without any events is taken off the selector until it is resumed
+        try:
+            if events:
+                self.selector.modify(self.sock, events, data=self)
+            else:
+                self.selector.unregister(self.sock)
+        except KeyError:
+            if events:
+                self.selector.register(self.sock, events, data=self)
+
+    def _events(self):
+        return 0 if self._paused else selectors.EVENT_READ
+
+    def pause(self, mailbox):
+        # stop reading from the sender until the destination mailbox has room again
+        self._paused = True
+        mailbox.waiting.append(self)
+        self._watch(self._events())
+
+    def resume(self):
+        self._paused = False
+        if self.sock is not None:
+            self._watch(self._events())
 
 
     def process_events(self, mask):
@@ -45,83 +87,141 @@ class Message():
             self.write()
 
     def read(self):
-        self._read()
-        
         if self._content_len is None:
             self.process_lenheader()
        
         if self._content_len is not None:
-            if self._content_len == 1: # client teardown
-                client_id = pickle.loads(self._recv_buffer)
-                return client_id
+            if self._content_len == self.TEARDOWN: # client teardown
+                return self.process_teardown()
+            elif self._content_len == self.SESSION_REQUEST: # client keeps connection open
+                self.upgrade()
+            elif self._content_len == self.REGISTER: # client announces its direct endpoint
+                self.process_register()
+            elif self._content_len == self.LOOKUP: # client asks for a direct endpoint
+                self._set_selector_events_mask("w")
             elif self._content_len: # client sends msg to mailbox 
-                if self.content is None:
+                if self._recv_buffer is None and self.outbuf.full():
+                    self.pause(self.outbuf)
+                elif self.content is None:
                     self.process_content()
             else: # client checks its mailbox 
                 self._set_selector_events_mask("w")
 
 
-    def _read(self):
+    def _recv_into(self, view):
+        # reads directly into the target buffer, the read size grows while the socket keeps up
         try:
-            chunk = self.sock.recv(self.CHUNKSIZE)
+            nbytes = self.sock.recv_into(view[:self._recv_chunksize])
         except BlockingIOError:
-            pass
-        else:
-            if chunk:
-                self._recv_chunks.append(chunk)
-                self._recv_chunks_size += len(chunk)
-            else: 
-                raise RuntimeError("Peer closed connection")
+            return 0
+        if not nbytes:
+            raise ConnectionClosed("Peer closed connection")
+        if nbytes == self._recv_chunksize:
+            self._recv_chunksize = min(2 * self._recv_chunksize, self.MAX_CHUNKSIZE)
+        return nbytes
 
     def process_lenheader(self):
-        self._recv_buffer += b''.join(self._recv_chunks)
-        self._recv_chunks.clear()
-        self._recv_chunks_size = 0
-        if len(self._recv_buffer) >= self.HDRLEN:
-            self._content_len = struct.unpack("!I", self._recv_buffer[:self.HDRLEN])[0]
-            self._recv_buffer = self._recv_buffer[self.HDRLEN:]
+        self._hdr_received += self._recv_into(memoryview(self._hdr)[self._hdr_received:])
+        if self._hdr_received == self.HDRLEN:
+            self._content_len = struct.unpack("!I", self._hdr)[0]
+            self._hdr_received = 0
+
+    def _recv_content(self, size):
+        # the content buffer is allocated once from the length header and filled in place
+        if self._recv_buffer is None:
+            self._recv_buffer = self.server.allocate(size)
+            self._recv_received = 0
+        with memoryview(self._recv_buffer) as view:
+            self._recv_received += self._recv_into(view[self._recv_received:])
+        if self._recv_received == size:
+            content = self._recv_buffer
+            self._recv_buffer = None
+            return content
 
     def process_content(self):
-        conlen = self._content_len
-        if len(self._recv_buffer) + self._recv_chunks_size >= conlen:
-            self._recv_buffer += b''.join(self._recv_chunks)
-            self._recv_chunks.clear()
-            self._recv_chunks_size = 0
-            self.content = self._recv_buffer[:conlen]
-            self._recv_buffer = self._recv_buffer[conlen:]
-            self.outbuf.append(self.content)
+        self.content = self._recv_content(self._content_len)
+        if self.content is not None:
+            self.deliver(self.port, self.content)
+            self.close()
+
+    def process_register(self):
+        content = self._recv_content(2)
+        if content is not None:
+            endpoint = (self.addr[0], struct.unpack("!H", content)[0])
+            self.server.endpoints[self.port] = endpoint
+            logging.debug("[Connserver] Direct endpoint for mailbox %s: %s", self.port, endpoint)
             self.close()
 
+    def process_teardown(self):
+        # the client id follows the header and ends with the connection
+        if self._recv_buffer is None:
+            self._recv_buffer = bytearray()
+        try:
+            chunk = self.sock.recv(self.CHUNKSIZE)
+        except BlockingIOError:
+            return
+        if chunk:
+            self._recv_buffer += chunk
+        else:
+            return self._recv_buffer.decode()
+
+    def deliver(self, port, content):
+        metrics.inc('connector_msgs_relayed_total')
+        metrics.inc('connector_bytes_relayed_total', len(content))
+        self.server.msgbuffers[port].append(content)
+        subscriber = self.server.subscribers.get(port)
+        if subscriber:
+            subscriber.push()
+
+
+    def upgrade(self):
+        session = Session(self.selector, self.sock, self.addr, self.port, self.server)
+        self.selector.modify(self.sock, selectors.EVENT_READ, data=session)
 
     def write(self):
         if not self.response_created:
             self.create_response()
         self._write()
+        if not self._send_queue:
+            self.close()
 
     def _write(self):
-        if self._send_buffer:
+        while self._send_queue:
+            view = self._send_queue[0]
             try:
-                sent = self.sock.send(self._send_buffer)
+                sent = self.sock.send(view[:self._send_chunksize])
             except BlockingIOError:
-                pass
+                return
+            if sent == self._send_chunksize:
+                self._send_chunksize = min(2 * self._send_chunksize, self.MAX_CHUNKSIZE)
+            if sent < len(view):
+                self._send_queue[0] = view[sent:]
             else:
-                self._send_buffer = self._send_buffer[sent:]
-                if sent and not self._send_buffer:
-                    self.close()
+                self._send_queue.popleft()
+
+    def _queue_msg(self, msg):
+        self._send_queue.append(memoryview(struct.pack("!I", len(msg))))
+        self._send_queue.append(memoryview(msg))
 
     def create_response(self):
-        if self.outbuf:
-            msg = self.outbuf.pop()
-            msg = struct.pack("!I", len(msg)) + msg
+        if self._content_len == self.LOOKUP:
+            endpoint = self.server.endpoints.get(self.port)
+            if endpoint:
+                self._queue_msg(struct.pack("!H", endpoint[1]) + endpoint[0].encode())
+            else:
+                self._send_queue.append(memoryview(self.EMPTY_MSG))
+        elif self.outbuf:
+            self._queue_msg(self.outbuf.popleft())
         else:
-            msg = self.EMPTY_MSG 
-        self._send_buffer += msg
+            self._send_queue.append(memoryview(self.EMPTY_MSG))
         self.response_created = True
 
 
     def close(self):
         try:
             self.selector.unregister(self.sock)
+        except KeyError:
+            pass # connection was paused
         except Exception as e:
             print(f"[Msg] Error: selector.unregister() exception for {self.addr}: {e!r}")
         try:
@@ -132,6 +232,91 @@ class Message():
             self.sock = None
 
 
+class Session(Message):
+
+    # frames on a session carry the destination mailbox port,
+    # ports below 1024 are reserved for requests to the connector itself
+    FRAMEHDR = struct.Struct("!IH")
+    HDRLEN = FRAMEHDR.size
+    CHECK = 0
+    TEARDOWN = 1
+    SUBSCRIBE = 2
+
+    def __init__(self, selector, sock, addr, port, server):
+        super().__init__(selector, sock, addr, port, server)
+        self._dst = None
+
+    def read(self):
+        while True:
+            if self._content_len is None:
+                try:
+                    self.process_lenheader()
+                except (ConnectionClosed, ConnectionResetError) as e:
+                    if self._hdr_received:
+                        raise
+                    # between two frames, e.g. the function party is done. A client that closes
+                    # with pushed frames still unread in its socket resets the connection instead.
+                    logging.debug("[Connserver] Session of mailbox %s closed: %r", self.port, e)
+                    self.close()
+                    return
+                if self._content_len is None:
+                    return
+            if self._dst >= 1024 and self._recv_buffer is None:
+                mailbox = self.server.msgbuffers[self._dst]
+                if mailbox.full():
+                    self.pause(mailbox)
+                    return
+            content = self._recv_content(self._content_len) if self._content_len else b""
+            if content is None:
+                return
+            dst = self._dst
+            self._content_len = None
+            self._dst = None
+
+            if dst == self.CHECK:
+                self.create_response()
+                self._watch(self._events())
+            elif dst == self.TEARDOWN:
+                return bytes(content).decode()
+            elif dst == self.SUBSCRIBE: # mailbox content is pushed from now on
+                self.server.subscribers[self.port] = self
+                self.push()
+            else:
+                self.deliver(dst, content)
+
+    def process_lenheader(self):
+        self._hdr_received += self._recv_into(memoryview(self._hdr)[self._hdr_received:])
+        if self._hdr_received == self.HDRLEN:
+            self._content_len, self._dst = self.FRAMEHDR.unpack(self._hdr)
+            self._hdr_received = 0
+
+    def _events(self):
+        events = super()._events()
+        if self._send_queue:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def _subscribed(self):
+        return self.server.subscribers.get(self.port) is self
+
+    def push(self):
+        # messages leave the mailbox one at a time, so a full mailbox keeps holding back its senders
+        if self.outbuf and not self._send_queue:
+            self._queue_msg(self.outbuf.popleft())
+            self._watch(self._events())
+
+    def write(self):
+        self._write()
+        while not self._send_queue and self.outbuf and self._subscribed():
+            self._queue_msg(self.outbuf.popleft())
+            self._write()
+        self._watch(self._events())
+
+    def close(self):
+        if self._subscribed():
+            del self.server.subscribers[self.port]
+        super().close()
+
 
 
 
@@ -139,6 +324,13 @@ class Connserver():
 
     FP_ID = 'function_party'
 
+    # bytes a mailbox may hold before senders to it are paused, None for no limit.
+    # Paused senders only resume while the mailbox is drained, so a quota is meant for push mode.
+    MAILBOX_QUOTA = None
+    # messages from this size on are received into memory-mapped temporary files
+    SPILL_THRESHOLD = None
+    SPILL_DIR = None
+
     def __init__(self, connaddr, client_ids):
 
         self.host, self.port = connaddr 
@@ -161,7 +353,9 @@ class Connserver():
         logging.debug("[Connserver] Client addresses: %s", self.address_table)
 
         # each participant starts with an empty mailbox
-        self.msgbuffers = {addr[1]: [] for addr in self.address_table.values()}
+        self.msgbuffers = {addr[1]: Mailbox(self.MAILBOX_QUOTA, name) for name, addr in self.address_table.items()}
+        self.subscribers = {}
+        self.endpoints = {}
 
         # The primary listening socket of the connector will spread the address table to the participants
         self.lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -172,7 +366,19 @@ class Connserver():
         self.sel.register(self.lsock, selectors.EVENT_READ, data=None)
         
         # put initialization msgs in queue of listening socket
-        self.msgbuffers[self.port] = [pickle.dumps(m) for m in self._create_init_msgs(nbclients)] 
+        self.msgbuffers[self.port] = Mailbox(name='connector')
+        self.msgbuffers[self.port].extend(codec.dumps(m) for m in self._create_init_msgs(nbclients))
+        metrics.add_collector(self.collect_metrics)
+
+    def allocate(self, size):
+        return allocate(size, self.SPILL_THRESHOLD, self.SPILL_DIR)
+
+    def collect_metrics(self):
+        # mailbox gauges are read when a snapshot is taken, so relaying pays nothing for them
+        for mailbox in self.msgbuffers.values():
+            metrics.set_gauge('connector_mailbox_depth', len(mailbox), mailbox=mailbox.name)
+            metrics.set_gauge('connector_mailbox_bytes', mailbox.nbytes, mailbox=mailbox.name)
+            metrics.set_gauge('connector_mailbox_waiting', len(mailbox.waiting), mailbox=mailbox.name)
 
     def _create_init_msgs(self, nb_clients):
         msgs = [self.address_table]*(nb_clients+1)
@@ -190,7 +396,9 @@ class Connserver():
                     else:
                         message = key.data
                         try:
-                            client_dropout = message.process_events(mask)
+                            with tracing.span('read' if mask & selectors.EVENT_READ else 'write', 'connector',
+                                              mailbox=self.msgbuffers[message.port].name, conn=type(message).__name__):
+                                client_dropout = message.process_events(mask)
                             if client_dropout:
                                 clients_running[client_dropout] = False
                                 message.close()
@@ -198,17 +406,21 @@ class Connserver():
                             logging.error("[Connserver]: Exception for %s : %s", message.addr, e)
                             message.close()
             self.sel.unregister(self.lsock)
-            self.sel.close()
         except KeyboardInterrupt:
             logging.error("[Connserver]: Keyboard interrupt")
         finally:
+            for key in list(self.sel.get_map().values()):
+                if key.data is not None:
+                    key.data.close()
             self.sel.close()
 
     def accept_wrapper(self, sock):
         conn, addr = sock.accept()
         sockport = sock.getsockname()[1]
+        metrics.inc('connector_connections_accepted_total')
         conn.setblocking(False)
-        message = Message(self.sel, conn, addr, self.msgbuffers[sockport]) 
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        message = Message(self.sel, conn, addr, sockport, self)
         self.sel.register(conn, selectors.EVENT_READ, data=message)
 
 
@@ -0,0 +1,80 @@
+import logging
+import socket
+import struct
+from threading import Thread
+
+from ESCAPED.setup.session import recv_frame
+
+LOOKUP = struct.pack("!I", 3)
+REGISTER = 4
+
+
+def register_endpoint(mailbox_addr, port):
+    with socket.create_connection(mailbox_addr) as sock:
+        sock.sendall(struct.pack("!IH", REGISTER, port))
+
+def lookup_endpoint(mailbox_addr):
+    with socket.create_connection(mailbox_addr) as sock:
+        sock.sendall(LOOKUP)
+        data = recv_frame(sock)
+    if data:
+        return (data[2:].decode(), struct.unpack_from("!H", data)[0])
+    return None
+
+
+class DirectEndpoint():
+
+    # frames are put into the inbox unauthenticated, so the endpoint only listens on the given host,
+    # all interfaces ('') are an explicit opt-in
+    def __init__(self, inbox, host='localhost'):
+        self.inbox = inbox
+        self.lsock = socket.create_server((host, 0))
+        self.port = self.lsock.getsockname()[1]
+        self._links = {}
+        Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.lsock.accept()
+            except OSError:
+                return # endpoint was closed
+            Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+    def _receive(self, conn):
+        with conn:
+            try:
+                while True:
+                    data = recv_frame(conn)
+                    if data is None:
+                        break
+                    self.inbox.put(data)
+            except OSError as e:
+                logging.debug("[Direct] Incoming link closed: %r", e)
+
+    def send(self, endpoint, payload):
+        sock = self._links.get(endpoint)
+        try:
+            if sock is None:
+                sock = socket.create_connection(endpoint)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._links[endpoint] = sock
+            sock.sendall(struct.pack("!I", len(payload)))
+            sock.sendall(payload)
+            return True
+        except OSError as e:
+            logging.info("[Direct] Cannot reach %s directly: %r", endpoint, e)
+            if sock is not None:
+                sock.close()
+            self._links.pop(endpoint, None)
+            return False
+
+    def close(self):
+        for sock in self._links.values():
+            sock.close()
+        self._links.clear()
+        try:
+            self.lsock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.lsock.close()
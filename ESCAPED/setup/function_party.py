@@ -3,33 +3,56 @@ import logging
 from collections import deque
 import socket
 import struct
-import pickle
+import queue
 
+from ESCAPED.core import codec, metrics, tracing
 from ESCAPED.core.escaped_function_party import ESCAPEDFunctionParty
+from ESCAPED.setup.session import Session, drain, recvall
+from ESCAPED.setup.direct import DirectEndpoint, register_endpoint, lookup_endpoint
 
 class FP(ESCAPEDFunctionParty):
 
     TIMEOUT_THRESHOLD = 10 
-    CHUNK_LEN = 4096 
+    REQUEST_WINDOW = 4
     MAILBOX_SIZE = 10 
     RCV_REQUEST = bytearray(4) 
+    PERSISTENT = False
+    PUSH = False
+    POLL_TIMEOUT = 1
+    DIRECT = False
+    DIRECT_HOST = 'localhost' # interface the direct endpoint listens on
+    DIRECT_MIN_BYTES = 64 * 1024
+    BLOCK_SIZE = 16 * 1024 * 1024
 
     def __init__(self, connector_addr):
 
         self._input_buf = deque()
-        self._addrs = self._rcv(connector_addr)
+        self._assembler = codec.Assembler(lambda head: self.stream_destination(head[1], head[0]))
+        self._addrs = codec.loads(self._rcv(connector_addr))
         self.peers = [p for p in self._addrs.keys() if p != self.FP_ID]
+        self._arrivals = queue.Queue()
+        self._session = Session(self._addrs[self.FP_ID]) if self.PERSISTENT or self.PUSH else None
+        if self.PUSH:
+            self._session.subscribe(self._arrivals)
+
+        # bulk payloads can be streamed directly, the connector only tells where to
+        self._direct = None
+        self._endpoints = {}
+        if self.DIRECT:
+            self._direct = DirectEndpoint(self._arrivals, self.DIRECT_HOST)
+            register_endpoint(self._addrs[self.FP_ID], self._direct.port)
 
     def _encode(self, msg):
-        emsg = pickle.dumps((self.FP_ID, msg))
-        return struct.pack('!I', len(emsg)) + emsg
+        return metrics.timed_iter(codec.dumps_blocks((self.FP_ID, msg), self.BLOCK_SIZE), 'encode_seconds', party=self.FP_ID)
 
     def _decode(self, msg):
-        return pickle.loads(msg)
+        with metrics.timer('decode_seconds', party=self.FP_ID):
+            return self._assembler.feed(msg)
 
 
     def get_next_msg(self):
-        self._check_mailbox()
+        # wait for incoming data instead of spinning on the timeout check
+        self._check_mailbox(block=len(self._input_buf) == 1 and self.waiting_for_peers())
         return self._input_buf.popleft()
 
     def add_to_msg_queue(self, msg):
@@ -39,22 +62,60 @@ class FP(ESCAPEDFunctionParty):
     def queue_empty(self):
         return not bool(self._input_buf) 
 
+    @tracing.traced('send_to_peer', lambda req, peer: {'to': peer, **tracing.msg_args(req)})
     def send_to_peer(self, req, peer):
+        endpoint = None
+        for i, emsg in enumerate(self._encode(req)):
+            if i == 0 and self._direct and (len(emsg) >= self.DIRECT_MIN_BYTES or codec.is_stream(emsg)):
+                endpoint = self._lookup_endpoint(peer)
+            if not (endpoint and self._direct.send(endpoint, emsg)):
+                self._relay(emsg, peer)
+
+    def _relay(self, emsg, peer):
         addr = self._addrs[peer]
-        emsg = self._encode(req)
+        if self._session:
+            self._session.send(addr[1], emsg)
+            return
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             sock.connect(addr)
-            sock.sendall(emsg)
+            sock.sendall(struct.pack('!I', len(emsg)) + emsg)
+
+    def _lookup_endpoint(self, peer):
+        if peer not in self._endpoints:
+            endpoint = lookup_endpoint(self._addrs[peer])
+            if not endpoint:
+                return None # not registered yet, use the relay
+            self._endpoints[peer] = endpoint
+        return self._endpoints[peer]
+
+    def _check_mailbox(self, block=False):
+        if not self.PUSH:
+            addr = self._addrs[self.FP_ID]
+            for _ in range(self.MAILBOX_SIZE):
+                data = self._session.check_mailbox() if self._session else self._rcv(addr)
+                if not data:
+                    break
+                self._accept(data)
+        for data in drain(self._arrivals, self.POLL_TIMEOUT if block and self.PUSH else 0):
+            self._accept(data)
+
+    def _accept(self, data):
+        try :
+            mail = self._decode(data)
+        except:
+            logging.error("[instFP] cannot decode this message of length %s. Will do nothing.", len(data))
+            return
+        if mail: # None while a streamed message is incomplete
+            self._input_buf.append(mail)
 
-    def _check_mailbox(self):
-        addr = self._addrs[self.FP_ID]
-        for _ in range(self.MAILBOX_SIZE):
-            mail = self._rcv(addr)
-            if mail:
-                self._input_buf.append(mail)
-            else:
-                break
+    def teardown(self):
+        self._assembler.close()
+        if self._direct:
+            self._direct.close()
+        if self._session:
+            self._session.close()
 
+    @tracing.traced('_rcv')
     def _rcv(self, addr):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
              sock.connect(addr)
@@ -62,21 +123,10 @@ class FP(ESCAPEDFunctionParty):
              hdr = sock.recv(4)
              conlen = struct.unpack('!I', hdr)[0]
              if conlen:
-                 rcvlen = 0
-                 chunks = []
-                 while rcvlen < conlen:
-                     chunk = sock.recv(self.CHUNK_LEN) 
-                     chunks.append(chunk)
-                     rcvlen += len(chunk)
-                     if not chunk:
-                         logging.warning("[instFP] Something went wrong while receiving a msg.") 
-                         return None
-                 data = b''.join(chunks)
-                 try :
-                     msg = self._decode(data[:conlen])
-                     return msg
-                 except:
-                     logging.error("[instFP] cannot decode this message of length %s. Will do nothing.", len(data))
+                 data = recvall(sock, conlen)
+                 if data is None:
+                     logging.warning("[instFP] Something went wrong while receiving a msg.") 
+                 return data
              else:
                  return None
 
@@ -0,0 +1,242 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+from ESCAPED.core import metrics, tracing
+from ESCAPED.core.precision import DTYPE_MODES, set_dtype_mode, accuracy_report
+from ESCAPED.setup import loader
+from ESCAPED.setup.connector import Connserver
+from ESCAPED.setup.peer import Peer
+from ESCAPED.setup.function_party import FP
+
+# Runs the connector, every peer and the function party in processes of their own, so that
+# the participants do not share one interpreter. Each role can also be started on its own,
+# e.g. on different hosts:
+#
+#   python -m ESCAPED.setup.launcher run data.csv --peers 4 --push --output gram.npy
+#   python -m ESCAPED.setup.launcher connector client_1 client_2 --address 0.0.0.0:9999
+#   python -m ESCAPED.setup.launcher peer client_1 part1.csv --address connector:9999
+#   python -m ESCAPED.setup.launcher fp --address connector:9999 --output gram.npy
+
+TRANSPORT_FLAGS = ['persistent', 'push', 'direct']
+
+
+def parse_address(addr):
+    host, _, port = addr.rpartition(':')
+    return (host or 'localhost', int(port))
+
+def configure(settings):
+    # transport settings are class attributes, they have to be applied in every process
+    for flag in TRANSPORT_FLAGS:
+        if settings.get(flag):
+            setattr(Peer, flag.upper(), True)
+            setattr(FP, flag.upper(), True)
+    if settings.get('direct_host') is not None:
+        Peer.DIRECT_HOST = FP.DIRECT_HOST = settings['direct_host']
+    if settings.get('window'):
+        FP.REQUEST_WINDOW = settings['window']
+    set_dtype_mode(settings.get('dtype', 'float64'), Peer, FP)
+    if settings.get('metrics_port'):
+        metrics.serve(settings['metrics_port'])
+    if settings.get('trace'):
+        tracing.enable()
+    logging.basicConfig(format='%(levelname)s:%(processName)s:%(message)s', level=settings.get('loglevel', logging.WARNING))
+
+def split_rows(nbrows, nb_peers):
+    cuts = [(nbrows // nb_peers)*i for i in range(nb_peers)] + [nbrows]
+    return [(cuts[i], cuts[i+1] - cuts[i]) for i in range(nb_peers)]
+
+
+def run_connector(address, peer_ids, settings, ready=None):
+    configure(settings)
+    connector = Connserver(address, peer_ids)
+    if ready is not None:
+        ready.set() # listening sockets are bound, participants may connect
+    connector.run()
+    export_trace(settings)
+
+def run_peer(peer_id, address, path, settings, startrow=0, nbrows=None):
+    configure(settings)
+    peer = Peer.fromfile(peer_id, address, path, startrow, nbrows, **load_args(settings))
+    peer.cooperate()
+    export_trace(settings)
+
+def run_fp(address, output, settings):
+    configure(settings)
+    fp = FP(address)
+    fp.cooperate()
+    with open(output, 'wb') as f:
+        np.save(f, fp.get_dot_product())
+    logging.info("[Launcher] Dot product written to %s", output)
+    export_trace(settings)
+
+def load_args(settings):
+    return {'ncols': settings['ncols']} if settings.get('ncols') else {}
+
+def export_trace(settings):
+    if settings.get('trace'):
+        tracing.export(settings['trace'])
+
+
+class Launcher():
+
+    STARTUP_TIMEOUT = 30
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, address, settings=None, context=None):
+        self.address = address
+        self.settings = settings or {}
+        self._ctx = multiprocessing.get_context(context)
+        self._procs = []
+
+    def _settings(self, offset, name):
+        # every process serves its metrics on a port of its own, counting up from --metrics-port,
+        # and writes its trace next to the merged one
+        settings = dict(self.settings)
+        if settings.get('metrics_port'):
+            settings['metrics_port'] += offset
+        if settings.get('trace'):
+            settings['trace'] = self._trace_part(name)
+        return settings
+
+    def _trace_part(self, name):
+        root, ext = os.path.splitext(self.settings['trace'])
+        return f"{root}.{name}{ext or '.json'}"
+
+    def _start(self, name, target, *args):
+        proc = self._ctx.Process(target=target, args=args, name=name)
+        proc.start()
+        self._procs.append(proc)
+        return proc
+
+    def run(self, path, nb_peers=None, peer_files=None, output=None):
+        """Splits the rows of path among nb_peers peers, or hands one file of peer_files to each
+        peer, and returns the dot product computed by the function party."""
+        if peer_files:
+            parts = [(f, 0, None) for f in peer_files]
+        else:
+            nbrows = loader.count_rows(path, **load_args(self.settings))
+            parts = [(path, start, rows) for start, rows in split_rows(nbrows, nb_peers)]
+        peer_ids = ['client_'+str(i+1) for i in range(len(parts))]
+        keep = output is not None
+        if not keep:
+            fd, output = tempfile.mkstemp(suffix='.npy')
+            os.close(fd)
+
+        t0 = time.time()
+        try:
+            ready = self._ctx.Event()
+            self._start('connector', run_connector, self.address, peer_ids, self._settings(0, 'connector'), ready)
+            if not ready.wait(self.STARTUP_TIMEOUT):
+                raise RuntimeError("[Launcher] Connector did not come up")
+            for i, (peer_id, (f, start, rows)) in enumerate(zip(peer_ids, parts)):
+                self._start(peer_id, run_peer, peer_id, self.address, f, self._settings(i+1, peer_id), start, rows)
+            self._start('function_party', run_fp, self.address, output, self._settings(len(parts)+1, 'function_party'))
+            self._wait()
+            if self.settings.get('trace'):
+                self._merge_traces(['connector', *peer_ids, 'function_party'])
+            logging.info("[Launcher] %s peers finished in %.3fs", len(peer_ids), time.time() - t0)
+            return np.load(output)
+        finally:
+            self.terminate()
+            if not keep:
+                os.remove(output)
+
+    def _merge_traces(self, names):
+        parts = [self._trace_part(name) for name in names]
+        tracing.merge(parts, self.settings['trace'])
+        for part in parts:
+            os.remove(part)
+        logging.info("[Launcher] Trace written to %s", self.settings['trace'])
+
+    def _wait(self):
+        # a participant that fails would leave the others waiting forever
+        while any(proc.is_alive() for proc in self._procs):
+            for proc in self._procs:
+                if proc.exitcode:
+                    raise RuntimeError(f"[Launcher] {proc.name} exited with code {proc.exitcode}")
+            time.sleep(self.POLL_INTERVAL)
+        for proc in self._procs:
+            if proc.exitcode:
+                raise RuntimeError(f"[Launcher] {proc.name} exited with code {proc.exitcode}")
+
+    def terminate(self):
+        for proc in self._procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        self._procs = []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ESCAPED.setup.launcher', description="Run ESCAPED participants as processes.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--address', type=parse_address, default=('localhost', 9999), help="connector address, host:port")
+    for flag in TRANSPORT_FLAGS:
+        common.add_argument('--'+flag, action='store_true')
+    common.add_argument('--direct-host', help="interface for direct links, default localhost, '' for all")
+    common.add_argument('--window', type=int, help="outstanding requests of the function party per peer")
+    common.add_argument('--dtype', choices=list(DTYPE_MODES), default='float64')
+    common.add_argument('--ncols', type=int, help="columns of raw binary float64 data files")
+    common.add_argument('--metrics-port', type=int, help="serve metrics for Prometheus on this local port")
+    common.add_argument('--trace', help="write a Chrome trace event file (.json) of the run")
+    common.add_argument('-v', '--verbose', action='store_true')
+    roles = parser.add_subparsers(dest='role', required=True)
+
+    run = roles.add_parser('run', parents=[common], help="connector, peers and function party on this host")
+    run.add_argument('data', nargs='+', help="one data file split among --peers, or one file per peer")
+    run.add_argument('--peers', type=int, help="number of peers sharing the rows of a single data file")
+    run.add_argument('--output', help="where to keep the dot product (.npy)")
+    run.add_argument('--validate', action='store_true', help="compare the dot product to the plaintext one")
+
+    connector = roles.add_parser('connector', parents=[common])
+    connector.add_argument('peer_ids', nargs='+')
+
+    peer = roles.add_parser('peer', parents=[common])
+    peer.add_argument('peer_id')
+    peer.add_argument('data')
+    peer.add_argument('--startrow', type=int, default=0)
+    peer.add_argument('--nbrows', type=int)
+
+    fp = roles.add_parser('fp', parents=[common])
+    fp.add_argument('--output', required=True)
+
+    args = parser.parse_args(argv)
+    settings = {flag: getattr(args, flag) for flag in TRANSPORT_FLAGS}
+    settings['window'] = args.window
+    settings['direct_host'] = args.direct_host
+    settings['dtype'] = args.dtype
+    settings['loglevel'] = logging.INFO if args.verbose else logging.WARNING
+    settings['metrics_port'] = args.metrics_port
+    settings['trace'] = args.trace
+    settings['ncols'] = args.ncols
+
+    if args.role == 'run':
+        if args.peers and len(args.data) > 1:
+            parser.error("--peers splits a single data file")
+        configure({**settings, 'metrics_port': None, 'trace': None}) # these are the participants' business
+        launcher = Launcher(args.address, settings)
+        if len(args.data) > 1:
+            dp = launcher.run(None, peer_files=args.data, output=args.output)
+        else:
+            dp = launcher.run(args.data[0], args.peers or 2, output=args.output)
+        print("dot product of shape", dp.shape)
+        if args.validate:
+            data = np.concatenate([loader.load(f, **load_args(settings)) for f in args.data])
+            print("accuracy", accuracy_report(dp, data))
+    elif args.role == 'connector':
+        run_connector(args.address, args.peer_ids, settings)
+    elif args.role == 'peer':
+        run_peer(args.peer_id, args.address, args.data, settings, args.startrow, args.nbrows)
+    elif args.role == 'fp':
+        run_fp(args.address, args.output, settings)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
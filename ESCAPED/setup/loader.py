@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Loads a peer's share of the data as a C-contiguous array of the requested dtype.
+# .npy files and raw binary files (rows of ncols values of raw_dtype, no header) are memory-mapped,
+# so only the requested rows are ever read. A csv is scanned for line ends to find the requested
+# rows and only those are parsed, chunk by chunk, straight into a preallocated array.
+
+RAW_SUFFIXES = ('.bin', '.raw', '.dat')
+SCAN_BYTES = 64 * 1024 * 1024
+CSV_CHUNK_ROWS = 64 * 1024
+
+
+def _kind(path):
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == '.npy':
+        return 'npy'
+    return 'raw' if suffix in RAW_SUFFIXES else 'csv'
+
+def _rows(path, kind, ncols=None, raw_dtype=np.float64):
+    # the data as an array of rows, memory-mapped where the format allows it
+    if kind == 'npy':
+        return np.load(path, mmap_mode='r')
+    if ncols is None:
+        raise ValueError(f"[Loader] Raw binary file {path} needs the number of columns")
+    rowsize = ncols * np.dtype(raw_dtype).itemsize
+    nbrows = os.path.getsize(path) // rowsize
+    if not nbrows:
+        return np.empty((0, ncols), dtype=raw_dtype)
+    return np.memmap(path, dtype=raw_dtype, mode='r', shape=(nbrows, ncols))
+
+
+def line_offsets(path, startrow=0, nbrows=None):
+    """Byte offsets of the start of row startrow and of the end of the requested rows, and
+    the number of rows between them. Only line ends are looked at, nothing is parsed."""
+    size = os.path.getsize(path)
+    if not size:
+        return 0, 0, 0
+    mm = np.memmap(path, dtype=np.uint8, mode='r')
+    wanted = [startrow] + ([startrow + nbrows] if nbrows is not None else [])
+    found = [0 if row == 0 else None for row in wanted] + [None] * (2 - len(wanted))
+    lines = 0 # complete lines before the current scan position
+    for pos in range(0, size, SCAN_BYTES):
+        ends = np.flatnonzero(mm[pos:pos+SCAN_BYTES] == ord('\n'))
+        for i, row in enumerate(wanted):
+            if found[i] is None and lines + len(ends) >= row:
+                found[i] = pos + int(ends[row - lines - 1]) + 1
+        lines += len(ends)
+        if None not in found: # without nbrows every line is counted
+            break
+    else:
+        if mm[size-1] != ord('\n'):
+            lines += 1 # last row without a line end
+    del mm
+    start = size if found[0] is None else found[0]
+    end = size if found[1] is None else found[1]
+    total = min(lines, startrow + nbrows) if nbrows is not None else lines
+    return start, end, max(total - startrow, 0)
+
+def count_rows(path, ncols=None, raw_dtype=np.float64):
+    kind = _kind(path)
+    if kind == 'csv':
+        return line_offsets(path)[2]
+    return _rows(path, kind, ncols, raw_dtype).shape[0]
+
+
+def load_csv(path, startrow=0, nbrows=None, dtype=np.float64):
+    start, end, nbrows = line_offsets(path, startrow, nbrows)
+    with open(path, 'rb') as f:
+        first = f.readline()
+        ncols = len(first.split(b',')) if first.strip() else 0
+        out = np.empty((nbrows, ncols), dtype=dtype)
+        f.seek(start)
+        pos = 0
+        if nbrows:
+            for chunk in pd.read_csv(f, sep=',', header=None, index_col=False, nrows=nbrows,
+                                     chunksize=CSV_CHUNK_ROWS, dtype=dtype, engine='c'):
+                out[pos:pos+len(chunk)] = chunk.to_numpy(dtype=dtype, copy=False)
+                pos += len(chunk)
+    if pos != nbrows:
+        raise ValueError(f"[Loader] Expected {nbrows} rows from {path}, got {pos}")
+    return out
+
+def load(path, startrow=0, nbrows=None, dtype=np.float64, ncols=None, raw_dtype=np.float64):
+    """Rows startrow to startrow+nbrows of a .npy, raw binary or csv file as a C-contiguous array.
+    Memory-mapped files are only copied where a conversion to dtype is needed."""
+    kind = _kind(path)
+    if kind == 'csv':
+        return load_csv(path, startrow, nbrows, dtype)
+    rows = _rows(path, kind, ncols, raw_dtype)
+    stop = None if nbrows is None else startrow + nbrows
+    return np.ascontiguousarray(rows[startrow:stop], dtype=dtype)
@@ -0,0 +1,59 @@
+import mmap
+import tempfile
+import time
+from collections import deque
+
+from ESCAPED.core import metrics, tracing
+
+
+def allocate(size, spill_threshold=None, spill_dir=None):
+    # large payloads are received straight into an anonymous memory-mapped temp file
+    if spill_threshold is not None and size >= spill_threshold:
+        with tempfile.TemporaryFile(dir=spill_dir) as f:
+            f.truncate(size)
+            return mmap.mmap(f.fileno(), size)
+    return bytearray(size)
+
+
+class Mailbox():
+
+    def __init__(self, quota=None, name=None):
+        self.quota = quota
+        self.name = name
+        self.nbytes = 0
+        self.total_msgs = 0 # everything ever delivered
+        self.total_bytes = 0
+        self.waiting = [] # connections paused until there is room again
+        self._msgs = deque()
+        self._arrivals = deque() # delivery times for the relay latency, None while neither metrics nor tracing are on
+
+    def __len__(self):
+        return len(self._msgs)
+
+    def full(self):
+        return self.quota is not None and self.nbytes >= self.quota
+
+    def append(self, msg):
+        self._msgs.append(msg)
+        self._arrivals.append(time.perf_counter() if metrics.enabled or tracing.enabled else None)
+        self.nbytes += len(msg)
+        self.total_msgs += 1
+        self.total_bytes += len(msg)
+
+    def extend(self, msgs):
+        for msg in msgs:
+            self.append(msg)
+
+    def popleft(self):
+        msg = self._msgs.popleft()
+        arrival = self._arrivals.popleft()
+        if arrival is not None:
+            now = time.perf_counter()
+            metrics.observe('connector_relay_latency_seconds', now - arrival)
+            tracing.interval('mailbox', 'connector', arrival, now, mailbox=self.name, nbytes=len(msg))
+        self.nbytes -= len(msg)
+        if self.waiting and not self.full():
+            waiting, self.waiting = self.waiting, []
+            for conn in waiting:
+                conn.resume()
+        return msg
@@ -1,12 +1,15 @@
 import numpy as np 
-import pandas as pd
 import logging
 from collections import deque
 import socket
 import struct
-import pickle
+import queue
 
+from ESCAPED.core import codec, metrics, tracing
 from ESCAPED.core.escaped_peer import ESCAPEDPeer, PPRole
+from ESCAPED.setup import loader
+from ESCAPED.setup.session import Session, drain, recvall
+from ESCAPED.setup.direct import DirectEndpoint, register_endpoint, lookup_endpoint
 
 class Peer(ESCAPEDPeer):
     
@@ -15,8 +18,14 @@ class Peer(ESCAPEDPeer):
     TIMEOUT_THRESHOLD = 1 
 
     RCV_REQUEST = bytearray(4)
-    CHUNK_LEN = 4096
     MAILBOX_SIZE = 10
+    PERSISTENT = False
+    PUSH = False
+    POLL_TIMEOUT = 1
+    DIRECT = False
+    DIRECT_HOST = 'localhost' # interface the direct endpoint listens on
+    DIRECT_MIN_BYTES = 64 * 1024
+    BLOCK_SIZE = 16 * 1024 * 1024
 
 
     def __init__(self, name, connector_addr, data):
@@ -24,7 +33,7 @@ class Peer(ESCAPEDPeer):
         self.own_peer_id = name
         
         # initialization
-        self._addrs = self._rcv(connector_addr)
+        self._addrs = codec.loads(self._rcv(connector_addr))
 
         self.peers = [p for p in list(self._addrs.keys()) if p != self.FP_ID and p != self.own_peer_id] 
 
@@ -33,15 +42,31 @@ class Peer(ESCAPEDPeer):
 
         # message buffer
         self._input_buf = deque()
+        self._assembler = codec.Assembler()
 
         self._data = data 
 
+        # one long-lived connection to the connector for all traffic
+        self._arrivals = queue.Queue()
+        self._session = Session(self._addrs[self.own_peer_id]) if self.PERSISTENT or self.PUSH else None
+        if self.PUSH:
+            self._session.subscribe(self._arrivals)
+
+        # bulk payloads can be streamed directly, the connector only tells where to
+        self._direct = None
+        self._endpoints = {}
+        if self.DIRECT:
+            self._direct = DirectEndpoint(self._arrivals, self.DIRECT_HOST)
+            register_endpoint(self._addrs[self.own_peer_id], self._direct.port)
+
     @classmethod
-    def fromfile(cls, name, connector_addr, path_to_data_csv, startrow=0, nbrows=None):
-        data = pd.read_csv(path_to_data_csv, sep=',', header=None, index_col=False,  skiprows=startrow, nrows=nbrows) 
+    def fromfile(cls, name, connector_addr, path, startrow=0, nbrows=None, **load_args):
+        # csv, .npy or raw binary (see ESCAPED.setup.loader), loaded in the precision the peer computes in
+        data = loader.load(path, startrow, nbrows, cls.DTYPE, **load_args)
         return cls(name, connector_addr, data) 
 
 
+    @tracing.traced('_rcv')
     def _rcv(self, addr):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             sock.connect(addr)
@@ -49,51 +74,55 @@ class Peer(ESCAPEDPeer):
             hdr = sock.recv(4)
             conlen = struct.unpack("!I", hdr)[0]
             if conlen:
-                rcvlen = 0
-                chunks = []
-                while rcvlen < conlen:
-                    chunk = sock.recv(self.CHUNK_LEN)
-                    chunks.append(chunk)
-                    rcvlen += len(chunk) 
-                    if not chunk:
-                        logging.warning("[instPeer] %s: Something went wrong while receiving a msg.", self.own_peer_id)
-                        return None
-                data = b''.join(chunks)
-                try :
-                    msg = self._decode(data[:conlen])
-                    return msg
-                except:
-                    logging.error("[instPeer] cannot decode this message. Will do nothing.")
+                data = recvall(sock, conlen)
+                if data is None:
+                    logging.warning("[instPeer] %s: Something went wrong while receiving a msg.", self.own_peer_id)
+                return data
             else: #no message available
                 return None
 
+    def _accept(self, data):
+        if data is None: # wake-up call, see wake()
+            return
+        try :
+            mail = self._decode(data)
+        except:
+            logging.error("[instPeer] cannot decode this message. Will do nothing.")
+            return
+        if mail: # None while a streamed message is incomplete
+            self._input_buf.append(mail)
+
     def _encode(self, msg):
-        emsg = pickle.dumps((self.own_peer_id , msg))
-        msghdr = struct.pack("!I", len(emsg))
-        return msghdr + emsg
+        return metrics.timed_iter(codec.dumps_blocks((self.own_peer_id, msg), self.BLOCK_SIZE), 'encode_seconds', party=self.own_peer_id)
 
 
     def _decode(self, msg):
-        return pickle.loads(msg)
+        with metrics.timer('decode_seconds', party=self.own_peer_id):
+            return self._assembler.feed(msg)
 
 
     def get_next_msg(self):
-        self._check_mailbox()
+        self._check_mailbox(block=not self._input_buf)
         if self._input_buf:
             return self._input_buf.popleft()
         else:
             return None, None
 
 
-    def _check_mailbox(self):
-        addr = self._addrs[self.own_peer_id]
-        for _ in range(self.MAILBOX_SIZE):
-            mail = self._rcv(addr)
-            if mail:
-                self._input_buf.append(mail)
-            else:
-                break
+    def _check_mailbox(self, block=False):
+        if not self.PUSH:
+            addr = self._addrs[self.own_peer_id]
+            for _ in range(self.MAILBOX_SIZE):
+                data = self._session.check_mailbox() if self._session else self._rcv(addr)
+                if not data:
+                    break
+                self._accept(data)
+        for data in drain(self._arrivals, self.POLL_TIMEOUT if block and self.PUSH else 0):
+            self._accept(data)
        
+    def wake(self):
+        self._arrivals.put(None)
+
     def answer_userdefreq(self, req):
         answer = req.spec.upper()
         return answer 
@@ -103,7 +132,7 @@ class Peer(ESCAPEDPeer):
 
 
     def own_data_as_np_array(self):
-        return self._data
+        return np.ascontiguousarray(self._data, dtype=self.DTYPE)
 
     def own_labels_as_np_array(self):
         return self._labels
@@ -113,18 +142,44 @@ class Peer(ESCAPEDPeer):
     def send_to_function_party(self, msg):
         self.send_to_peer(msg, self.FP_ID) 
 
+    @tracing.traced('send_to_peer', lambda msg, peer: {'to': peer, **tracing.msg_args(msg)})
     def send_to_peer(self, msg, peer):
+        # all frames of one message take the same route
+        endpoint = None
+        for i, emsg in enumerate(self._encode(msg)):
+            logging.debug("[instPeer] %s ready to send frame %s of len %s to %s", self.own_peer_id, i, len(emsg), peer)
+            if i == 0 and self._direct and (len(emsg) >= self.DIRECT_MIN_BYTES or codec.is_stream(emsg)):
+                endpoint = self._lookup_endpoint(peer)
+            if not (endpoint and self._direct.send(endpoint, emsg)):
+                self._relay(emsg, peer)
+
+    def _relay(self, emsg, peer):
         addr = self._addrs[peer]
-        emsg = self._encode(msg)
-        logging.debug("[instPeer] %s ready to send message of len %s to %s", self.own_peer_id, len(emsg), peer)
+        if self._session:
+            self._session.send(addr[1], emsg)
+            return
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             sock.connect(addr)
-            sock.sendall(emsg)
+            sock.sendall(struct.pack("!I", len(emsg)) + emsg)
+
+    def _lookup_endpoint(self, peer):
+        if peer not in self._endpoints:
+            endpoint = lookup_endpoint(self._addrs[peer])
+            if not endpoint:
+                return None # not registered yet, use the relay
+            self._endpoints[peer] = endpoint
+        return self._endpoints[peer]
 
     def teardown(self):
+        self._assembler.close()
+        if self._direct:
+            self._direct.close()
+        if self._session:
+            self._session.teardown(self.own_peer_id.encode())
+            return
         addr = self._addrs[self.own_peer_id]
         msghdr = struct.pack("!I", 1)
-        emsg = msghdr + pickle.dumps(self.own_peer_id)
+        emsg = msghdr + self.own_peer_id.encode()
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             sock.connect(addr)
             sock.sendall(emsg)
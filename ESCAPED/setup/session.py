@@ -0,0 +1,85 @@
+import logging
+import queue
+import socket
+import struct
+from threading import Thread
+
+
+def recv_frame(sock):
+    hdr = recvall(sock, 4)
+    if hdr is None:
+        return None
+    conlen = struct.unpack("!I", hdr)[0]
+    if conlen:
+        return recvall(sock, conlen)
+    return None
+
+def recvall(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    rcvlen = 0
+    while rcvlen < n:
+        nbytes = sock.recv_into(view[rcvlen:])
+        if not nbytes:
+            if rcvlen:
+                logging.warning("[Session] Connection closed while receiving a msg.")
+            return None
+        rcvlen += nbytes
+    return buf
+
+def drain(inbox, timeout=0):
+    frames = []
+    try:
+        if timeout:
+            frames.append(inbox.get(timeout=timeout))
+        while True:
+            frames.append(inbox.get_nowait())
+    except queue.Empty:
+        pass
+    return frames
+
+
+class Session():
+
+    SESSION_REQUEST = struct.pack("!I", 2)
+    FRAMEHDR = struct.Struct("!IH")
+    CHECK = 0
+    TEARDOWN = 1
+    SUBSCRIBE = 2
+
+    def __init__(self, addr):
+        self.sock = socket.create_connection(addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(self.SESSION_REQUEST)
+
+    def subscribe(self, inbox):
+        self.sock.sendall(self.FRAMEHDR.pack(0, self.SUBSCRIBE))
+        Thread(target=self._receive_pushed, args=(inbox,), daemon=True).start()
+
+    def _receive_pushed(self, inbox):
+        try:
+            while True:
+                data = recv_frame(self.sock)
+                if data is None:
+                    break
+                inbox.put(data)
+        except OSError:
+            pass # session was closed locally
+
+    def send(self, port, payload):
+        self.sock.sendall(self.FRAMEHDR.pack(len(payload), port))
+        self.sock.sendall(payload)
+
+    def check_mailbox(self):
+        self.sock.sendall(self.FRAMEHDR.pack(0, self.CHECK))
+        return recv_frame(self.sock)
+
+    def teardown(self, payload):
+        self.send(self.TEARDOWN, payload)
+        self.close()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError as e:
+            logging.error("[Session] Error while closing session: %r", e)
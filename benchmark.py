@@ -0,0 +1,185 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import platform
+import resource
+import socket
+import subprocess
+import time
+import numpy as np
+from queue import Empty
+from threading import Thread
+
+from ESCAPED.core import metrics
+from ESCAPED.setup.function_party import FP
+from ESCAPED.setup.peer import Peer
+from ESCAPED.setup.connector import Connserver
+from ESCAPED.extensions.outlier import kNNOutlierDetection
+
+# Sweeps the size of a federation and records, for every run, the time spent in each phase,
+# the peak memory and the traffic through the connector as one json line of the results file.
+#
+#   python benchmark.py --peers 2 4 8 --samples 1000 4000 --features 10 --imbalance 1 4 --output results.jsonl
+
+ALGORITHMS = {'knn': 'knn_simple_score', 'wknn': 'knn_weighted_score', 'lof': 'lof_score', 'ldof': 'ldof_score'}
+
+
+def peer_sizes(nb_samples, nb_peers, imbalance):
+    # the largest share is `imbalance` times the smallest one
+    weights = imbalance ** np.linspace(0, 1, nb_peers)
+    cuts = np.round(np.cumsum(weights) / weights.sum() * nb_samples).astype(int)
+    return np.diff(np.concatenate([[0], cuts]))
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def timed(target, results, key):
+    # wall and cpu time of a participant's thread
+    def run():
+        wall, cpu = time.perf_counter(), time.thread_time()
+        target()
+        results[key] = {'wall': time.perf_counter() - wall, 'cpu': time.thread_time() - cpu}
+    return Thread(target=run)
+
+
+def histogram_seconds(snapshot, timings):
+    # total seconds of masking, of the matrix products by kind and of encoding and decoding, per participant
+    for key, hist in snapshot['histograms'].items():
+        name, _, labels = key.partition('{')
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', labels))
+        if name == 'peer_matmul_seconds':
+            party, phase = labels['peer'], 'matmul_' + labels['kind']
+        elif name == 'peer_mask_seconds':
+            party, phase = labels['peer'], 'mask'
+        elif name in ('encode_seconds', 'decode_seconds'):
+            party, phase = labels['party'], name[:-len('_seconds')]
+        else:
+            continue
+        timings.setdefault(party, {})[phase] = {'wall': hist['sum'], 'count': hist['count']}
+
+
+def run_once(config):
+    rng = np.random.default_rng(config['seed'])
+    data = rng.normal(0, 3, size=(config['samples'], config['features']))
+    sizes = peer_sizes(config['samples'], config['peers'], config['imbalance'])
+    cuts = np.concatenate([[0], np.cumsum(sizes)])
+    peer_ids = ['client_'+str(i+1) for i in range(config['peers'])]
+    for flag in ['persistent', 'push', 'direct']:
+        setattr(Peer, flag.upper(), config[flag])
+        setattr(FP, flag.upper(), config[flag])
+
+    timings = {}
+    metrics.enable()
+    start = time.perf_counter()
+    address = ('localhost', free_port())
+    connector = Connserver(address, peer_ids)
+    threads = [timed(connector.run, timings, 'connector')]
+    threads[0].start()
+    for i, peer_id in enumerate(peer_ids):
+        peer = Peer(peer_id, address, data[cuts[i]:cuts[i+1]])
+        threads.append(timed(peer.cooperate, timings, peer_id))
+        threads[-1].start()
+    fp = FP(address)
+    threads.append(timed(fp.cooperate, timings, 'function_party'))
+    threads[-1].start()
+    for thread in threads:
+        thread.join()
+    online = time.perf_counter() - start
+    histogram_seconds(metrics.snapshot(), timings)
+
+    t = time.perf_counter()
+    dot_product = fp.get_dot_product()
+    timings['get_dot_product'] = {'wall': time.perf_counter() - t}
+
+    t = time.perf_counter()
+    detector = kNNOutlierDetection(dot_product, config['k'])
+    timings['neighbor_index'] = {'wall': time.perf_counter() - t}
+    for algo, method in ALGORITHMS.items():
+        t = time.perf_counter()
+        getattr(detector, method)(config['k'])
+        timings[algo] = {'wall': time.perf_counter() - t}
+
+    mailboxes = [mb for port, mb in connector.msgbuffers.items() if port != connector.port]
+    return {'online_wall': online,
+            'phases': timings,
+            'peer_wall_max': max(timings[p]['wall'] for p in peer_ids),
+            'peer_sizes': sizes.tolist(),
+            'msgs_relayed': sum(mb.total_msgs for mb in mailboxes),
+            'bytes_relayed': sum(mb.total_bytes for mb in mailboxes),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def _child(config, queue):
+    try:
+        queue.put(run_once(config))
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+def run_isolated(config, poll_interval=1, time_limit=None):
+    # every run gets a fresh process, so the peak memory is its own
+    ctx = multiprocessing.get_context()
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_child, args=(config, queue))
+    proc.start()
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+    while True:
+        try:
+            result = queue.get(timeout=poll_interval)
+            break
+        except Empty:
+            if deadline is not None and time.monotonic() > deadline: # e.g. a participant died and the others wait for it
+                proc.terminate()
+                result = {'error': 'timeout'}
+                break
+            if not proc.is_alive(): # killed without reporting, e.g. by a signal or out of memory
+                try:
+                    result = queue.get(timeout=poll_interval)
+                except Empty:
+                    result = {'error': f'exit code {proc.exitcode}'}
+                break
+    proc.join()
+    return result
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the online and offline phase of ESCAPED.")
+    parser.add_argument('--peers', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--samples', type=int, nargs='+', default=[1000])
+    parser.add_argument('--features', type=int, nargs='+', default=[10])
+    parser.add_argument('--imbalance', type=float, nargs='+', default=[1.0], help="largest over smallest peer share")
+    parser.add_argument('--k', type=int, default=15)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--persistent', action='store_true')
+    parser.add_argument('--push', action='store_true')
+    parser.add_argument('--direct', action='store_true')
+    parser.add_argument('--time-limit', type=float, default=600, help="seconds a run may take before it is stopped")
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    args = parser.parse_args(argv)
+
+    common = {'version': version(), 'python': platform.python_version(), 'numpy': np.__version__,
+              'host': platform.node(), 'cpus': multiprocessing.cpu_count()}
+    with open(args.output, 'a') as out:
+        for peers, samples, features, imbalance, rep in itertools.product(
+                args.peers, args.samples, args.features, args.imbalance, range(args.repeat)):
+            config = {'peers': peers, 'samples': samples, 'features': features, 'imbalance': imbalance,
+                      'k': args.k, 'seed': rep, 'persistent': args.persistent, 'push': args.push, 'direct': args.direct}
+            result = run_isolated(config, time_limit=args.time_limit)
+            record = {**common, 'timestamp': time.time(), 'config': config, 'result': result}
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            print(json.dumps({**config, 'online_wall': result.get('online_wall'), 'error': result.get('error')}))
+
+
+if __name__ == '__main__':
+    main()
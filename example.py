@@ -7,6 +7,7 @@ from ESCAPED.setup.function_party import FP
 from ESCAPED.setup.peer import Peer
 from ESCAPED.setup.connector import Connserver
 from ESCAPED.extensions.outlier import kNNOutlierDetection
+from ESCAPED.core.precision import set_dtype_mode, accuracy_report
 
 
 # settings to play around with
@@ -14,6 +15,13 @@ nb_peers = 6 # number of simulated input parties
 nb_samples = 1000 # total number of samples in the combined data set
 nb_features = 2 # number of features, set to 2 if you want to plot the data 
 
+# transport settings
+persistent = False # each participant keeps one open connection to the connector
+push = False # the connector pushes new messages instead of being polled
+direct = False # large payloads are streamed between participants, bypassing the connector
+dtype_mode = 'float64' # 'float32' halves traffic and memory, 'mixed' unmasks float32 parts in float64
+pack_own_gram = False # peers send only the upper triangle of their own gram
+
 # outlier detection parameters
 k = 15
 n = nb_samples // 20  # top_n outlier
@@ -36,6 +44,12 @@ data = np.random.normal(0, 3, size=(nb_samples, nb_features))
 cuts = [(nb_samples // nb_peers)*i for i in range(nb_peers)] + [nb_samples] 
 peer_ids = ['client_'+str(i+1) for i in range(nb_peers)]
 
+Peer.PERSISTENT = FP.PERSISTENT = persistent
+Peer.PUSH = FP.PUSH = push
+Peer.DIRECT = FP.DIRECT = direct
+set_dtype_mode(dtype_mode, Peer, FP)
+Peer.PACK_OWN_GRAM = pack_own_gram
+
 # our helper for establishing connections
 connector_address = ('localhost', 9999)
 connector = Connserver(connector_address, peer_ids)
@@ -59,9 +73,9 @@ fp_t.join()
 dp_by_escaped = fp.get_dot_product()
 
 # compare to reference dot product
-dp_cmp = data @ np.transpose(data)
-dp_correct = np.isclose(dp_by_escaped.astype(np.float64), dp_cmp.astype(np.float64)).all() 
-print("DP is correct:", dp_correct) 
+report = accuracy_report(dp_by_escaped, data)
+print("DP is correct:", report['allclose'])
+print("Maximum deviation: %.3g (relative %.3g)" % (report['max_abs_error'], report['max_rel_error']))
 
 
 # offline phase: outlier detection